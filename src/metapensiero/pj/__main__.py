@@ -7,11 +7,15 @@
 
 import argparse
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import logging
+import os
 from pathlib import Path
 import sys
+import time
 
 from . import api
+from .manifest import Manifest
 
 log = logging.getLogger(__name__)
 
@@ -41,9 +45,33 @@ parser.add_argument('-5', '--es5', dest='es5', action='store_true',
                     help="Also transpile to ES5 using BabelJS.")
 parser.add_argument('--transform-runtime', action='store_true', dest='truntime',
                     help="Add transform runtime as plugin during transpile")
+parser.add_argument('--no-babel-cache', dest='babel_cache',
+                    action='store_false',
+                    help="Do not use the cache of the BabelJS output kept "
+                    "in ~/.cache/pj/babel when transpiling")
+parser.add_argument('--babel-load-time', action='store_true',
+                    help="Report the time needed to load BabelJS. Its "
+                    "bundle can be changed with the PJ_BABEL_JS environment "
+                    "variable")
 parser.add_argument('-o', '--output', type=str,
                     help="Output file/directory where to save the generated "
                     "code")
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                    help="Number of worker processes to use when compiling "
+                    "more than one file. Defaults to the number of CPUs")
+parser.add_argument('--incremental', action='store_true',
+                    help="When compiling a directory, skip the files that "
+                    "haven't changed since the last compilation and remove "
+                    "the outputs of the deleted ones. A manifest file is "
+                    "kept in the output directory for that")
+parser.add_argument('-w', '--watch', action='store_true',
+                    help="After compiling, keep watching the sources for "
+                    "changes and recompile the modified files. Implies "
+                    "--incremental for directories")
+parser.add_argument('--watch-interval', type=float, default=1.0,
+                    metavar='SECONDS',
+                    help="Interval between the checks for changes when "
+                    "using --watch. Defaults to one second")
 parser.add_argument('-d', '--debug', action='store_true',
                     help="Enable error reporting")
 parser.add_argument('--pdb', action='store_true',
@@ -65,6 +93,16 @@ parser.add_argument('--inline-map', action='store_true',
                     " file, useful when transpiling with BabelJS externally "
                     "but without access to the cli. Ignored "
                     "when transpiling.")
+parser.add_argument('--no-source-map', dest='sourcemap',
+                    action='store_false',
+                    help="Do not generate the source-map. Ignored when "
+                    "transpiling.")
+parser.add_argument('--runtime-module', metavar='MODULE',
+                    help="Import the runtime snippets from MODULE instead of "
+                    "adding their code to every output file. Requires ES6")
+parser.add_argument('--write-runtime', metavar='FILE',
+                    help="Write the module with the runtime snippets, to be "
+                    "used with --runtime-module, to FILE")
 parser.add_argument('--source-name', help="When using '-s' together with"
                     " '--inline-map' this option is necessary to produce a"
                     " valid sourcemap which needs a name for the source file")
@@ -84,11 +122,19 @@ class Reporter:
         print(*args, **kwargs)
 
 
+def _use_babel_cache(enable):
+    if enable and api.get_babel_cache() is None:
+        api.configure_babel_cache()
+
+
 def transform(src_fname, dst_fname=None, transpile=False, enable_es6=False,
               enable_stage3=False, **kw):
     kw.pop('source_name', None)
+    babel_cache = kw.pop('babel_cache', False)
     if transpile:
+        _use_babel_cache(babel_cache)
         kw.pop('inline_map', None)
+        kw.pop('sourcemap', None)
         api.transpile_py_file(src_fname, dst_fname,
                               enable_stage3=enable_stage3,
                               **kw)
@@ -98,6 +144,52 @@ def transform(src_fname, dst_fname=None, transpile=False, enable_es6=False,
                            enable_stage3=enable_stage3, **kw)
 
 
+def walk_sources(src_root, dst_root=None):
+    """Walk the `src_root` directory tree and yield a ``(src_fname,
+    dst_dir)`` tuple for every Python module found, creating the
+    corresponding directories under `dst_root` if it's specified.
+    """
+    src_dirs = deque([src_root])
+    while len(src_dirs) > 0:
+        sdir = src_dirs.popleft()
+        if dst_root:
+            ddir = dst_root / sdir.relative_to(src_root)
+            if not ddir.exists():
+                ddir.mkdir()
+        else:
+            ddir = None
+        for spath in sorted(sdir.iterdir()):
+            if spath.name in ('__pycache__', '__init__.py'):
+                continue
+            elif spath.is_dir():
+                src_dirs.append(spath)
+            elif spath.suffix == '.py':
+                yield str(spath), str(ddir) if ddir else None
+
+
+def transform_files(tasks, jobs=1, **kw):
+    """Transform every ``(src_fname, dst_fname)`` pair in `tasks`, using a
+    pool of `jobs` worker processes when it's greater than one. Yield a
+    ``(src_fname, exception)`` tuple for each pair in the same order of
+    `tasks`, where the exception is ``None`` if the transformation
+    succeeded.
+    """
+    if jobs > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as ex:
+            futures = [ex.submit(transform, src_fname, dst_fname, **kw)
+                       for src_fname, dst_fname in tasks]
+            for (src_fname, dst_fname), future in zip(tasks, futures):
+                yield src_fname, future.exception()
+    else:
+        for src_fname, dst_fname in tasks:
+            try:
+                transform(src_fname, dst_fname, **kw)
+            except Exception as e:
+                yield src_fname, e
+            else:
+                yield src_fname, None
+
+
 def transform_string(input, transpile=False, enable_es6=False,
                      enable_stage3=False, **kw):
     inline_map = kw.get('inline_map', False)
@@ -105,24 +197,156 @@ def transform_string(input, transpile=False, enable_es6=False,
     if inline_map and source_name is None:
         raise ValueError("A source name is needed, please specify it using "
                          "the '--source-name option.")
+    sourcemap = kw.get('sourcemap', True)
+    runtime_module = kw.get('runtime_module')
     if transpile:
+        _use_babel_cache(kw.get('babel_cache', False))
         res, src_map = api.transpile_pys(input, enable_stage3=enable_stage3,
-                                         src_filename=source_name)
+                                         src_filename=source_name,
+                                         runtime_module=runtime_module)
     else:
         res, src_map = api.translates(input, enable_es6=enable_es6,
                                       enable_stage3=enable_stage3,
-                                      src_filename=source_name)
-    if kw.get('inline_map', False):
+                                      src_filename=source_name,
+                                      sourcemap=sourcemap and inline_map,
+                                      runtime_module=runtime_module)
+    if inline_map and src_map is not None:
         res += src_map.stringify(inline_comment=True)
     return res
 
 
+def write_runtime(dst_fname, transpile=False, enable_stage3=False):
+    js_text = api.translate_runtime(enable_stage3)
+    if transpile:
+        js_text = api.transpile_es6s(js_text, enable_stage3=enable_stage3)[0]
+    with open(dst_fname, 'w') as dst:
+        dst.write(js_text)
+
+
+def report_babel_load_time(rep):
+    """Load BabelJS into the interpreters pool, so that it's reused by the
+    following transpilations, and report how long it took."""
+    pool = api.get_babel_pool()
+    pool.warm(1)
+    for elapsed in pool.load_times:
+        rep.print_err("BabelJS loaded from %s in %.3f seconds" % (
+            pool.babel_js or api.BABEL_COMPILER, elapsed))
+
+
 def check_interpreter_supported():
     if sys.version_info < (3, 5):
         raise UnsupportedPythonError('JavaScripthon needs at least'
                                      ' Python 3.5 to run')
 
 
+def _is_modified(stats, fname):
+    """Return ``True`` if the size or the modification time of the file
+    changed since the last call, ``False`` if they didn't and ``None`` if
+    the file doesn't exist anymore, in which case its stats are dropped."""
+    if stats is None:
+        return True
+    try:
+        st = os.stat(fname)
+    except OSError:
+        stats.pop(fname, None)
+        return None
+    st = (st.st_size, st.st_mtime_ns)
+    if stats.get(fname) == st:
+        return False
+    stats[fname] = st
+    return True
+
+
+def compile_sources(sources, args, rep, manifests=None, stats=None, jobs=1):
+    """Compile the ``(src_path, dst_path)`` pairs in `sources`, where the
+    source may be either a file or a directory, returning ``1`` if the
+    compilation of any file failed and ``0`` otherwise.
+
+    When `manifests` is a dict, directories are compiled incrementally
+    using a :class:`~.manifest.Manifest` for each one, kept in it between
+    calls. When `stats` is a dict, it's used to skip the files whose size
+    and modification time didn't change since the last call, whether
+    their compilation succeeded or not.
+    """
+    result = 0
+    freeargs = {
+        'truntime': args.truntime,
+        'inline_map': args.inline_map,
+        'sourcemap': args.sourcemap,
+        'source_name': args.source_name,
+        'runtime_module': args.runtime_module,
+        'babel_cache': args.babel_cache
+    }
+    build_options = {
+        'es5': args.es5,
+        'es6': args.es6,
+        'stage3': args.stage3,
+        'truntime': args.truntime,
+        'inline_map': args.inline_map,
+        'sourcemap': args.sourcemap,
+        'runtime_module': args.runtime_module
+    }
+    tasks = []
+    dir_manifests = []
+    for src, dst in sources:
+        if src.is_dir():
+            dir_tasks = list(walk_sources(src, dst))
+            if manifests is not None:
+                manifest = manifests.get(src)
+                if manifest is None:
+                    manifest = manifests[src] = Manifest(dst or src, src,
+                                                         build_options)
+                for rpath in manifest.prune(s for s, d in dir_tasks):
+                    rep.print("Removed file %s" % rpath)
+                stale_tasks = []
+                for s, d in dir_tasks:
+                    if not manifest.is_stale(s):
+                        continue
+                    modified = _is_modified(stats, s)
+                    if modified is None:
+                        # removed after the directory was walked
+                        for rpath in manifest.remove(s):
+                            rep.print("Removed file %s" % rpath)
+                    elif modified:
+                        stale_tasks.append((s, d))
+                dir_tasks = stale_tasks
+                dir_manifests.append((manifest, [s for s, d in dir_tasks]))
+            tasks.extend(dir_tasks)
+        elif _is_modified(stats, str(src)):
+            tasks.append((str(src), str(dst) if dst else None))
+    done = set()
+    for src_fname, e in transform_files(
+            tasks, jobs, transpile=args.es5, enable_es6=args.es6,
+            enable_stage3=args.stage3, **freeargs):
+        if e is None:
+            rep.print("Compiled file %s" % src_fname)
+            done.add(src_fname)
+            continue
+        if args.pdb:
+            import pdb
+            pdb.post_mortem(e.__traceback__)
+        elif args.debug:
+            raise e
+        else:
+            error = "%s: %s" % (e.__class__.__name__, e)
+            rep.print_err("An error occurred while compiling "
+                          "source file '%s'" % src_fname)
+            rep.print_err(error)
+        result = 1
+    tasks_dst = dict(tasks)
+    for manifest, src_fnames in dir_manifests:
+        for src_fname in src_fnames:
+            if src_fname in done:
+                manifest.record(src_fname, api.output_filenames(
+                    src_fname, tasks_dst[src_fname], None, args.es5,
+                    args.inline_map, args.sourcemap))
+            else:
+                manifest.discard(src_fname)
+        if manifest.dirty:
+            manifest.save()
+    return result
+
+
 def main(args=None, fout=None, ferr=None):
     result = 0
     rep = Reporter(fout, ferr)
@@ -130,13 +354,19 @@ def main(args=None, fout=None, ferr=None):
     freeargs = {
         'truntime': args.truntime,
         'inline_map': args.inline_map,
-        'source_name': args.source_name
+        'sourcemap': args.sourcemap,
+        'source_name': args.source_name,
+        'runtime_module': args.runtime_module,
+        'babel_cache': args.babel_cache
     }
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
         logging.getLogger().setLevel(logging.DEBUG)
         log.debug('Log started')
-    if not (args.files or args.string):
+    if args.babel_load_time:
+        report_babel_load_time(rep)
+    if not (args.files or args.string or args.write_runtime or
+            args.babel_load_time):
         rep.print_err("Error: You have to supply either a string with -s or a "
                       "filename")
         result = 3
@@ -182,6 +412,10 @@ def main(args=None, fout=None, ferr=None):
     else:
         try:
             check_interpreter_supported()
+            if args.write_runtime:
+                write_runtime(args.write_runtime, args.es5, args.stage3)
+                rep.print("Written runtime module %s" % args.write_runtime)
+            sources = []
             for fname in args.files:
                 src = Path(fname)
                 if not src.exists():
@@ -191,54 +425,51 @@ def main(args=None, fout=None, ferr=None):
                     dst = Path(args.output)
                 else:
                     dst = None
-                if src.is_dir():
-                    if dst and src != dst:
-                        if dst.exists() and not dst.is_dir():
-                            rep.print_err("Source is a directory but output exists "
-                                          "and it isn't")
-                            result = 1
-                            break
-                        if not dst.exists():
-                            dst.mkdir()
-                    src_root = src
-                    dst_root = dst
-                    src_dirs = deque([src_root])
-                    while len(src_dirs) > 0:
-                        sdir = src_dirs.popleft()
-                        if dst_root:
-                            ddir = dst_root / sdir.relative_to(src_root)
-                            if not ddir.exists():
-                                ddir.mkdir()
-                        else:
-                            ddir = None
-                        for spath in sdir.iterdir():
-                            if spath.name in ('__pycache__', '__init__.py'):
-                                continue
-                            elif spath.is_dir():
-                                src_dirs.append(spath)
-                                continue
-                            elif spath.suffix == '.py':
-                                try:
-                                    transform(
-                                        str(spath),
-                                        str(ddir) if ddir else None,
-                                        args.es5,
-                                        args.es6,
-                                        args.stage3,
-                                        **freeargs
-                                    )
-                                    rep.print("Compiled file %s" % spath)
-                                except Exception as e:
-                                    e.src_fname = spath
-                                    raise
+                if src.is_dir() and dst and src != dst:
+                    if dst.exists() and not dst.is_dir():
+                        rep.print_err("Source is a directory but output exists "
+                                      "and it isn't")
+                        result = 1
+                        break
+                    if not dst.exists():
+                        dst.mkdir()
+                sources.append((src, dst))
+            else:
+                if args.incremental or args.watch:
+                    manifests = {}
                 else:
+                    manifests = None
+                stats = {} if args.watch else None
+                # post-mortem debugging needs the original traceback, so
+                # don't use worker processes in that case
+                jobs = 1 if args.pdb or args.debug else args.jobs
+                if args.watch and args.es5:
+                    # the recompilations happen in this process, load
+                    # BabelJS here before the first compilation, whose
+                    # workers may then inherit it
+                    api.get_babel_pool().warm(1)
+                result = compile_sources(sources, args, rep, manifests, stats,
+                                         jobs)
+                if args.watch:
+                    rep.print("Watching for changes, press Ctrl-C to stop")
                     try:
-                        transform(fname, args.output, args.es5, args.es6,
-                                  args.stage3, **freeargs)
-                        rep.print("Compiled file %s" % fname)
-                    except Exception as e:
-                        e.src_fname = fname
-                        raise
+                        while True:
+                            time.sleep(args.watch_interval)
+                            # the translation happens in this process from
+                            # now on, so that the BabelJS context is reused
+                            try:
+                                result = compile_sources(sources, args, rep,
+                                                         manifests, stats)
+                            except Exception as e:
+                                if args.pdb or args.debug:
+                                    raise
+                                error = "%s: %s" % (e.__class__.__name__, e)
+                                rep.print_err("An error occurred during "
+                                              "processing.")
+                                rep.print_err(error)
+                                result = 1
+                    except KeyboardInterrupt:
+                        pass
         except Exception as e:
             if args.pdb:
                 import pdb
@@ -246,13 +477,8 @@ def main(args=None, fout=None, ferr=None):
             elif args.debug:
                 raise
             else:
-                src_fname = getattr(e, 'src_fname', None)
                 error = "%s: %s" % (e.__class__.__name__, e)
-                if src_fname:
-                    rep.print_err("An error occurred while compiling source "
-                                  "file '%s'" % src_fname)
-                else:
-                    rep.print_err("An error occurred during processing.")
+                rep.print_err("An error occurred during processing.")
                 rep.print_err(error)
             result = 1
     sys.exit(result)
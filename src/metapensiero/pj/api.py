@@ -7,25 +7,107 @@
 
 import ast
 import base64
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 import json
 import inspect
+import itertools
 import logging
 import os
+import queue
 import textwrap
+import threading
+import time
 
 import dukpy
 
-from .processor.transforming import Transformer
+from .cache import DiskCache, MemoryCache, cache_key, default_cache_dir
+from .processor.sourcemaps import SourceMap
+from .processor.transforming import (Transformer, get_transformations,
+                                     transformations_generation)
 from .processor.util import Block
 from .js_ast import JSStatements
 from . import transformations
 
 log = logging.getLogger(__name__)
 
-BABEL_COMPILER = os.path.join(os.path.dirname(__file__), 'data',
-                              'babel-6.18.1.min.js')
-BABEL_POLYFILL = os.path.join(os.path.dirname(__file__), 'data',
-                              'polyfill.min.js')
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+BABEL_FULL = os.path.join(DATA_DIR, 'babel-6.18.1.min.js')
+# the bundle built with "make babel-bundle", containing only the presets
+# and plugins actually used, that is much faster to load
+BABEL_REDUCED = os.path.join(DATA_DIR, 'babel-pj.min.js')
+BABEL_POLYFILL = os.path.join(DATA_DIR, 'polyfill.min.js')
+
+
+def default_babel_compiler():
+    """Return the path of the BabelJS bundle to use: the one given with the
+    ``PJ_BABEL_JS`` environment variable, otherwise the reduced bundle, if
+    it has been built, or the complete one."""
+    babel_js = os.environ.get('PJ_BABEL_JS')
+    if babel_js:
+        return babel_js
+    if os.path.exists(BABEL_REDUCED):
+        return BABEL_REDUCED
+    return BABEL_FULL
+
+
+BABEL_COMPILER = default_babel_compiler()
+
+PJ_VERSION = None
+
+PJ_FINGERPRINT = None
+
+
+def pj_version():
+    """Return the version of the installed package or, when the
+    distribution metadata isn't available, like in a source checkout, the
+    one written in the ``version.txt`` file of the checkout."""
+    global PJ_VERSION
+    if PJ_VERSION is None:
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:  # Python < 3.8
+            import pkg_resources
+
+            def version(name):
+                return pkg_resources.get_distribution(name).version
+
+            PackageNotFoundError = pkg_resources.DistributionNotFound
+        try:
+            PJ_VERSION = version('javascripthon')
+        except PackageNotFoundError:
+            version_txt = os.path.join(os.path.dirname(__file__), os.pardir,
+                                       os.pardir, os.pardir, 'version.txt')
+            try:
+                with open(version_txt, encoding='utf-8') as f:
+                    PJ_VERSION = f.read().strip()
+            except OSError:
+                PJ_VERSION = 'unknown'
+    return PJ_VERSION
+
+
+def pj_fingerprint():
+    """Return a digest of the version and of the Python sources of the
+    package. It's used as the invalidation key of the results stored by
+    the caches and the manifests, so that they are discarded also when the
+    code of the translator changes without a new release, like in a
+    development tree."""
+    global PJ_FINGERPRINT
+    if PJ_FINGERPRINT is None:
+        pkg_dir = os.path.dirname(os.path.abspath(__file__))
+        parts = [pj_version()]
+        for dirpath, dirnames, filenames in os.walk(pkg_dir):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                if fname.endswith('.py'):
+                    path = os.path.join(dirpath, fname)
+                    parts.append(os.path.relpath(path, pkg_dir))
+                    with open(path, 'rb') as f:
+                        parts.append(f.read())
+        PJ_FINGERPRINT = cache_key(*parts)
+    return PJ_FINGERPRINT
 
 
 def _calc_file_names(src_filename, dst_filename=None, map_filename=None):
@@ -52,6 +134,31 @@ def _calc_file_names(src_filename, dst_filename=None, map_filename=None):
     return dst_filename, map_filename, src_relpath, map_relpath
 
 
+def _calc_es6_file_names(dst_filename, map_filename):
+    """Calculate the paths of the intermediate ES6 files written when
+    transpiling."""
+    dst_name, dst_ext = os.path.splitext(dst_filename)
+    map_name, map_ext = os.path.splitext(map_filename)
+    return dst_name + '.es6' + dst_ext, map_name + '.es6' + map_ext
+
+
+def output_filenames(src_filename, dst_filename=None, map_filename=None,
+                     transpile=False, inline_map=False, sourcemap=True):
+    """Return the list of the files written by :func:`translate_file` or, if
+    `transpile` is true, by :func:`transpile_py_file` when called with the
+    same arguments."""
+    dst_filename, map_filename, _, _ = _calc_file_names(
+        src_filename, dst_filename, map_filename
+    )
+    if transpile:
+        return [dst_filename, map_filename,
+                *_calc_es6_file_names(dst_filename, map_filename)]
+    elif inline_map or not sourcemap:
+        return [dst_filename]
+    else:
+        return [dst_filename, map_filename]
+
+
 def _inline_src_map(src_map):
     src_map_data = ('data:text/json;base64,%s' %
         base64.b64encode(src_map.encode('utf-8')).decode('ascii'))
@@ -59,36 +166,58 @@ def _inline_src_map(src_map):
 
 
 def translate_file(src_filename, dst_filename=None, map_filename=None,
-                   enable_es6=False, enable_stage3=False, inline_map=False):
-    """Translate the given python source file to ES6 Javascript."""
+                   enable_es6=False, enable_stage3=False, inline_map=False,
+                   sourcemap=True, runtime_module=None):
+    """Translate the given python source file to ES6 Javascript.
+
+    The code is written to the destination file while it's produced,
+    without keeping all of it in memory. If `sourcemap` is false no source
+    map is generated nor written.
+    """
     dst_filename, map_filename, src_relpath, map_relpath = _calc_file_names(
         src_filename, dst_filename, map_filename
     )
     src_text = open(src_filename).readlines()
-    js_text, src_map = translates(src_text, True, src_relpath,
-                                  enable_es6=enable_es6,
-                                  enable_stage3=enable_stage3)
-    if inline_map:
-        js_text += src_map.stringify(inline_comment=True)
+    if TRANSLATION_CACHE is None:
+        # the code is written to the destination while it's serialized
+        js_code_block, src_text, src_offset = _translate_block(
+            src_text, True, None, False, enable_es6, enable_stage3,
+            runtime_module)
+        js_text = None
     else:
-        js_text += '\n//# sourceMappingURL=%s\n' % map_relpath
+        js_text, src_map = translates(src_text, True, src_relpath,
+                                      enable_es6=enable_es6,
+                                      enable_stage3=enable_stage3,
+                                      sourcemap=sourcemap,
+                                      runtime_module=runtime_module)
 
     with open(dst_filename, 'w') as dst:
-        dst.write(js_text)
-    if not inline_map:
+        if js_text is None:
+            src_map = js_code_block.write(dst, src_text, src_relpath,
+                                          src_offset, sourcemap=sourcemap)
+            _log_mappings(src_map, src_offset)
+        else:
+            dst.write(js_text)
+        if sourcemap:
+            if inline_map:
+                dst.write(src_map.stringify(inline_comment=True))
+            else:
+                dst.write('\n//# sourceMappingURL=%s\n' % map_relpath)
+    if sourcemap and not inline_map:
         with open(map_filename, 'w') as map:
-            map.write(src_map.stringify())
+            src_map.dump(map)
 
 
 def translate_object(py_obj, body_only=False, enable_es6=False,
-                     enable_stage3=False):
+                     enable_stage3=False, sourcemap=True):
     """Translate the given Python 3 object (function, class, etc.) to ES6
     Javascript.
 
     If `body_only` is ``True``, the object itself is discarded and only its
     body gets translated as it was a module body.
 
-    Return a ``(js_text, js_source_map)`` tuple.
+    Return a ``(js_text, js_source_map)`` tuple, where the source map is
+    ``None`` if `sourcemap` is false.
     """
     cwd = os.getcwd()
     src_filename = os.path.abspath(inspect.getsourcefile(py_obj))
@@ -98,16 +227,20 @@ def translate_object(py_obj, body_only=False, enable_es6=False,
     src_lines, sline_offset = inspect.getsourcelines(py_obj)
     # line offsets should be 0-based
     sline_offset = sline_offset - 1
-    with open(src_filename) as f:
-        complete_src = f.read()
+    if sourcemap:
+        with open(src_filename) as f:
+            complete_src = f.read()
+    else:
+        complete_src = None
     return translates(src_lines, True, src_filename, (sline_offset, 0),
                       body_only=body_only, complete_src=complete_src,
-                      enable_es6=enable_es6, enable_stage3=enable_stage3)
+                      enable_es6=enable_es6, enable_stage3=enable_stage3,
+                      sourcemap=sourcemap)
 
 
 def translates(src_text, dedent=True, src_filename=None, src_offset=None,
                body_only=False, complete_src=None, enable_es6=False,
-               enable_stage3=False):
+               enable_stage3=False, sourcemap=True, runtime_module=None):
     """Translate the given Python 3 source text to ES6 Javascript.
 
     If the string comes from a file, it's possible to specify the filename
@@ -118,6 +251,65 @@ def translates(src_text, dedent=True, src_filename=None, src_offset=None,
 
     Setting `body_only` to a true value will change the evaluation behavior to
     translate only the body of the first statement.
+
+    If `runtime_module` is given, the snippets needed by the code aren't
+    inlined but imported from that module, which can be produced with
+    :func:`translate_runtime`. This requires `enable_es6`.
+
+    Return a ``(js_text, js_source_map)`` tuple. When `sourcemap` is false
+    no mapping is computed and the source map is ``None``. If the
+    translation cache is enabled with :func:`configure_translation_cache`
+    the result may come from it, and then the source map must not be
+    modified.
+    """
+    if runtime_module is not None and not enable_es6:
+        raise ValueError("An external runtime module requires ES6")
+    cache = TRANSLATION_CACHE
+    if cache is None:
+        return _translates(src_text, dedent, src_filename, src_offset,
+                           body_only, complete_src, enable_es6, enable_stage3,
+                           sourcemap, runtime_module)
+    key = cache_key(pj_fingerprint(), _rules_signature(),
+                    ''.join(src_text) if isinstance(src_text, (tuple, list))
+                    else src_text,
+                    complete_src, src_filename,
+                    (dedent, tuple(src_offset or (0, 0)), body_only,
+                     enable_es6, enable_stage3, sourcemap, runtime_module))
+    result = cache.get(key)
+    if result is None:
+        result = _translates(src_text, dedent, src_filename, src_offset,
+                             body_only, complete_src, enable_es6,
+                             enable_stage3, sourcemap, runtime_module)
+        cache.set(key, result)
+    return result
+
+
+_RULES_SIGNATURE = (None, None)
+
+
+def _rules_signature():
+    """Return a digest of the names of the transformations in use, so that
+    the cached translations are discarded when they are changed with
+    :func:`~.processor.transforming.add_transformation`. It's computed
+    again only when the transformations change."""
+    global _RULES_SIGNATURE
+    generation, signature = _RULES_SIGNATURE
+    current = transformations_generation()
+    if generation != current:
+        table = get_transformations(transformations)
+        signature = cache_key(*sorted(
+            '%s: %s' % (cls.__name__, ', '.join(
+                '%s.%s' % (f.__module__, f.__qualname__) for f in funcs))
+            for cls, funcs in table.items()))
+        _RULES_SIGNATURE = (current, signature)
+    return signature
+
+
+def _translate_block(src_text, dedent, src_offset, body_only, enable_es6,
+                     enable_stage3, runtime_module):
+    """Translate the source to JS AST, returning a ``(block, src_text,
+    src_offset)`` tuple where `block` is a :class:`~.util.Block` ready to
+    be rendered and `src_offset` takes the dedent into account.
     """
     if isinstance(src_text, (tuple, list)):
         src_lines = src_text
@@ -142,7 +334,7 @@ def translates(src_text, dedent=True, src_filename=None, src_offset=None,
     else:
         dedented = src_text
     t = Transformer(transformations, JSStatements, es6=enable_es6,
-                    stage3=enable_stage3)
+                    stage3=enable_stage3, runtime_module=runtime_module)
     pyast = ast.parse(dedented)
     if body_only and hasattr(pyast, 'body') and len(pyast.body) == 1 \
        and hasattr(pyast.body[0], 'body'):
@@ -154,37 +346,153 @@ def translates(src_text, dedent=True, src_filename=None, src_offset=None,
         if isinstance(pyast.body[-1], ast.Return):
             pyast.body.pop()
     jsast = t.transform_code(pyast)
-    dline_offset = dcol_offset = 0
     if t.snippets:
         snipast = t.transform_snippets()
         snipast += jsast
         jsast = snipast
-    js_code_block = Block(jsast)
-    js_text = js_code_block.read()
-    if not src_filename:
-        src_filename = '<source>'
-
-    src_map = js_code_block.sourcemap(complete_src or src_text, src_filename,
-                                      (sline_offset, scol_offset),
-                                      (dline_offset, dcol_offset))
-    for t in src_map.tokens:
-        log.debug("js: (%d, %d)\t\t py: (%d, %d)\t txt: '%s'",
-                  t.dst_line, t.dst_col, t.src_line - sline_offset,
-                  t.src_col - scol_offset, t.mapping['text'])
+    return Block(jsast), src_text, (sline_offset, scol_offset)
+
+
+def _log_mappings(src_map, src_offset):
+    if src_map is not None and log.isEnabledFor(logging.DEBUG):
+        sline_offset, scol_offset = src_offset
+        for t in src_map.tokens:
+            log.debug("js: (%d, %d)\t\t py: (%d, %d)\t name: '%s'",
+                      t.dst_line, t.dst_col, t.src_line - sline_offset,
+                      t.src_col - scol_offset, t.name or '')
+
+
+def _translates(src_text, dedent, src_filename, src_offset, body_only,
+                complete_src, enable_es6, enable_stage3, sourcemap,
+                runtime_module):
+    js_code_block, src_text, src_offset = _translate_block(
+        src_text, dedent, src_offset, body_only, enable_es6, enable_stage3,
+        runtime_module)
+    js_text, src_map = js_code_block.render(complete_src or src_text,
+                                            src_filename or '<source>',
+                                            src_offset, sourcemap=sourcemap)
+    _log_mappings(src_map, src_offset)
     return js_text, src_map
 
 
+def _translate_item(item, options):
+    if isinstance(item, str):
+        return translates(item, **options)
+    src_text, src_filename = item
+    return translates(src_text, src_filename=src_filename, **options)
+
+
+def _translate_chunk(chunk, options):
+    results = []
+    for item in chunk:
+        try:
+            results.append(_translate_item(item, options))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def translate_many(sources, jobs=1, chunksize=16, return_exceptions=False,
+                   **options):
+    """Translate every item of the `sources` iterable, which may be either
+    a source text or a ``(src_text, src_filename)`` tuple, using
+    :func:`translates` with the given `options`. Return an iterator over
+    the ``(js_text, js_source_map)`` results, in the same order.
+
+    The sources are consumed and the results produced a few at a time, so
+    even a very large batch can be translated in bounded memory. If
+    `jobs` is greater than one, the translation is split in chunks of
+    `chunksize` sources distributed over a pool of worker processes.
+
+    The first error is raised when its result is reached, unless
+    `return_exceptions` is true, in which case the exception is produced
+    in place of the result.
+    """
+    if jobs <= 1:
+        for item in sources:
+            try:
+                result = _translate_item(item, options)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                result = e
+            yield result
+        return
+    sources = iter(sources)
+    chunks = iter(lambda: list(itertools.islice(sources, chunksize)), [])
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for chunk in itertools.chain(chunks, (None,)):
+            if chunk is not None:
+                pending.append(executor.submit(_translate_chunk, chunk,
+                                               options))
+            # keep a limited number of chunks in flight
+            while pending and (chunk is None or len(pending) > jobs * 2):
+                for result in pending.popleft().result():
+                    if isinstance(result, Exception) and \
+                       not return_exceptions:
+                        raise result
+                    yield result
+
+
+TRANSLATION_CACHE = None
+
+
+def _encode_translation(result):
+    js_text, src_map = result
+    return [js_text, None if src_map is None else src_map.encode()]
+
+
+def _decode_translation(value):
+    js_text, src_map = value
+    return js_text, None if src_map is None else SourceMap.decode(src_map)
+
+
+def configure_translation_cache(maxsize=128, directory=None, max_size=None):
+    """Enable a cache of the results of :func:`translates`, keyed by the
+    source text, the options and the version of pj. If `directory` is
+    given, the results are stored there on disk, up to `max_size` bytes,
+    otherwise up to `maxsize` of them are kept in memory. A `maxsize` of
+    ``0`` disables the cache. Return the new cache, whose ``stats()``
+    method reports hits and misses.
+    """
+    global TRANSLATION_CACHE
+    if directory is not None:
+        TRANSLATION_CACHE = DiskCache(directory, max_size,
+                                      _encode_translation,
+                                      _decode_translation)
+    elif maxsize:
+        TRANSLATION_CACHE = MemoryCache(maxsize)
+    else:
+        TRANSLATION_CACHE = None
+    return TRANSLATION_CACHE
+
+
+def get_translation_cache():
+    """Return the cache used by :func:`translates` or ``None`` if it's not
+    enabled."""
+    return TRANSLATION_CACHE
+
+
+def translate_runtime(enable_stage3=False):
+    """Translate all the snippets to an ES6 module that exports them, to be
+    used as the `runtime_module` of the other translations. Return its
+    code.
+    """
+    t = Transformer(transformations, JSStatements, es6=True,
+                    stage3=enable_stage3)
+    return Block(t.transform_runtime()).read()
+
+
 def transpile_es6s(es6_text, es6_filename=None, es6_sourcemap=None,
                    enable_stage3=False, **kw):
     """Transpile the given ES6 Javascript to ES5 Javascript using Dukpy
-    and babeljs."""
+    and babeljs. If `es6_sourcemap` is given, the returned source map is
+    chained with it, so that it refers to the original sources.
+    """
     opts = dict(sourceMaps=True)
     if es6_filename:
         opts['filename'] = es6_filename
-    if es6_sourcemap:
-        if isinstance(es6_sourcemap, str):
-            es6_sourcemap = es6_sourcemap.encode()
-        opts['inputSourceMap'] = es6_sourcemap
     opts['presets'] = ["es2015"]
     if enable_stage3:
         opts['presets'].append('stage-3')
@@ -192,7 +500,17 @@ def transpile_es6s(es6_text, es6_filename=None, es6_sourcemap=None,
     if truntime:
         opts['plugins'] = ['transform-runtime']
     res = babel_compile(es6_text, **opts)
-    return res['code'], res['map']
+    es5_sourcemap = res['map']
+    if es6_sourcemap:
+        # the maps are composed here instead of passing them to BabelJS as
+        # ``inputSourceMap``, which is much slower
+        if not isinstance(es6_sourcemap, SourceMap):
+            if isinstance(es6_sourcemap, bytes):
+                es6_sourcemap = es6_sourcemap.decode('utf-8')
+            es6_sourcemap = SourceMap.decode(es6_sourcemap)
+        es5_sourcemap = SourceMap.compose(SourceMap.decode(es5_sourcemap),
+                                          es6_sourcemap).encode()
+    return res['code'], es5_sourcemap
 
 
 def transpile_object(py_obj, body_only=False, es6_filename=None,
@@ -202,45 +520,44 @@ def transpile_object(py_obj, body_only=False, es6_filename=None,
     es6_text, es6_sourcemap = translate_object(py_obj, body_only=body_only,
                                                enable_es6=True,
                                                enable_stage3=enable_stage3)
-    return transpile_es6s(es6_text, es6_filename, es6_sourcemap.encode(),
+    return transpile_es6s(es6_text, es6_filename, es6_sourcemap,
                           enable_stage3=enable_stage3, **kw)
 
 
 def transpile_pys(src_text, dedent=True, src_filename=None, src_offset=None,
                   body_only=False, es6_filename=None, enable_stage3=False,
-                  **kw):
+                  runtime_module=None, **kw):
     """Transpile the given Python 3 source text to ES5 Javascript
     using Dukpy and babeljs.
     """
     es6_text, es6_sourcemap = translates(src_text, dedent, src_filename,
                                          src_offset, body_only, enable_es6=True,
-                                         enable_stage3=enable_stage3)
-    return transpile_es6s(es6_text, es6_filename, es6_sourcemap.encode(),
+                                         enable_stage3=enable_stage3,
+                                         runtime_module=runtime_module)
+    return transpile_es6s(es6_text, es6_filename, es6_sourcemap,
                           enable_stage3=enable_stage3, **kw)
 
 
 def transpile_py_file(src_filename, dst_filename=None, map_filename=None,
-                      enable_stage3=False, **kw):
+                      enable_stage3=False, runtime_module=None, **kw):
     """Transpile the given Python 3 source file to ES5 Javascript
     using Dukpy and babeljs.
     """
     dst_filename, map_filename, src_relpath, map_relpath = _calc_file_names(
         src_filename, dst_filename, map_filename
     )
-    dst_name, dst_ext = os.path.splitext(dst_filename)
-    map_name, map_ext = os.path.splitext(map_filename)
-    es6_dst_filename = dst_name + '.es6' + dst_ext
-    es6_map_filename = map_name + '.es6' + map_ext
+    es6_dst_filename, es6_map_filename = _calc_es6_file_names(dst_filename,
+                                                              map_filename)
     dst_dir = os.path.dirname(dst_filename)
     es6_map_relpath = os.path.relpath(es6_map_filename, dst_dir)
     es6_relpath = os.path.relpath(es6_dst_filename, dst_dir)
     src_text = open(src_filename).readlines()
     es6_text, es6_src_map = translates(
         src_text, True, src_relpath, enable_es6=True,
-        enable_stage3=enable_stage3)
+        enable_stage3=enable_stage3, runtime_module=runtime_module)
 
     es5_text, es5_src_map = transpile_es6s(es6_text, es6_relpath,
-                                           es6_src_map.encode(),
+                                           es6_src_map,
                                            enable_stage3=enable_stage3, **kw)
     es5_text += '\n//# sourceMappingURL=%s\n' % map_relpath
     es6_text += '\n//# sourceMappingURL=%s\n' % es6_map_relpath
@@ -273,7 +590,7 @@ def evaljs(js_text, load_es6_polyfill=False, **kwargs):
 
 def eval_object(py_obj, append=None, body_only=False, ret_code=False,
                 **kwargs):
-    js_text, _ = translate_object(py_obj, body_only)
+    js_text, _ = translate_object(py_obj, body_only, sourcemap=False)
     if append:
         js_text += append
     res = dukpy.evaljs(js_text, **kwargs)
@@ -283,7 +600,7 @@ def eval_object(py_obj, append=None, body_only=False, ret_code=False,
 
 
 def evals(py_text, body_only=False, ret_code=False, **kwargs):
-    js_text, _ = translates(py_text, body_only=body_only)
+    js_text, _ = translates(py_text, body_only=body_only, sourcemap=False)
     res = dukpy.evaljs(js_text, **kwargs)
     if ret_code:
         res = (res, js_text)
@@ -312,34 +629,248 @@ def evals_es6(py_text, body_only=False, ret_code=False, enable_stage3=False,
     return res
 
 
-BABEL_JS_CTX = None
+BABEL_TRANSFORM_CODE = (
+    'var bres, res;'
+    'bres = Babel.transform(dukpy.es6code, dukpy.babel_options);',
+    'res = {map: bres.map, code: bres.code};'
+)
+
+BABEL_SOURCES = {}
+
+BABEL_DIGESTS = {}
+
+
+def _babel_source(babel_js=None):
+    """Return the source code of BabelJS, reading it only once."""
+    babel_js = babel_js or BABEL_COMPILER
+    source = BABEL_SOURCES.get(babel_js)
+    if source is None:
+        with open(babel_js, 'r', encoding='utf-8') as f:
+            source = BABEL_SOURCES[babel_js] = f.read()
+    return source
+
+
+def _babel_digest(babel_js=None):
+    """Return the digest of the BabelJS bundle, computing it only once."""
+    babel_js = babel_js or BABEL_COMPILER
+    digest = BABEL_DIGESTS.get(babel_js)
+    if digest is None:
+        digest = BABEL_DIGESTS[babel_js] = cache_key(_babel_source(babel_js))
+    return digest
+
+
+def new_babel_interpreter(babel_js=None):
+    """Create a new ``dukpy.JSInterpreter`` with BabelJS loaded into it,
+    from the `babel_js` bundle or from :data:`BABEL_COMPILER`. Return a
+    tuple containing it and the loading time in seconds.
+    """
+    start = time.perf_counter()
+    source = _babel_source(babel_js)
+    interp = dukpy.JSInterpreter()
+    interp.evaljs(source)
+    elapsed = time.perf_counter() - start
+    if not interp.evaljs("typeof Babel === 'object' && "
+                         "typeof Babel.transform === 'function'"):
+        raise ValueError("The BabelJS bundle '%s' doesn't define "
+                         "Babel.transform()" % (babel_js or BABEL_COMPILER))
+    log.info("BabelJS loaded from '%s' in %.3f seconds",
+             babel_js or BABEL_COMPILER, elapsed)
+    return interp, elapsed
+
+
+class BabelPool:
+    """A bounded, thread-safe pool of JS interpreters with BabelJS
+    loaded. Interpreters are created lazily, up to `size`, when all the
+    existing ones are checked out and are never used by two threads at
+    the same time.
+
+    If `processes` is true the compilation happens instead in a pool of
+    `size` worker processes, each one with its own interpreter, so that
+    more than one CPU can be used.
+
+    The time spent loading BabelJS into every interpreter is appended to
+    `load_times`. A reduced bundle can be specified with `babel_js`.
+    """
+
+    def __init__(self, size=None, processes=False, babel_js=None):
+        self.size = size or os.cpu_count() or 1
+        self.processes = processes
+        self.babel_js = babel_js
+        self.load_times = []
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._executor = None
+        if processes:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.size, initializer=_babel_worker_init,
+                initargs=(babel_js,))
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                interp, elapsed = new_babel_interpreter(self.babel_js)
+                self.load_times.append(elapsed)
+                return interp
+            except BaseException:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def checkout(self):
+        """Context manager that lends an interpreter for exclusive use,
+        waiting for one to be available if the pool is exhausted."""
+        interp = self._acquire()
+        try:
+            yield interp
+        finally:
+            self._idle.put(interp)
+
+    def warm(self, count=None):
+        """Create interpreters in advance, up to `count` or the pool's
+        size."""
+        if self._executor is not None:
+            return
+        count = min(count or self.size, self.size)
+        interps = []
+        try:
+            while len(interps) < count and (self._created < self.size or
+                                            self._idle.qsize()):
+                interps.append(self._acquire())
+        finally:
+            for interp in interps:
+                self._idle.put(interp)
+
+    def compile(self, source, **options):
+        """Compile the given ES6 `source` using the given BabelJS
+        `options`."""
+        if self._executor is not None:
+            return self._executor.submit(babel_compile, source,
+                                         **options).result()
+        with self.checkout() as interp:
+            return interp.evaljs(BABEL_TRANSFORM_CODE, es6code=source,
+                                 babel_options=options)
+
+    def close(self):
+        """Release the interpreters and stop the worker processes, if
+        any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        while True:
+            try:
+                self._idle.get_nowait()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._created = 0
+
+
+BABEL_POOL = None
+BABEL_POOL_LOCK = threading.Lock()
+
+
+def _babel_worker_init(babel_js):
+    # Each worker process uses a single interpreter of its own. When the
+    # process is forked it inherits the pool of the parent, so replace it
+    # without closing. The cache is handled by the parent
+    global BABEL_POOL, BABEL_CACHE
+    BABEL_POOL = BabelPool(1, babel_js=babel_js)
+    BABEL_CACHE = None
+    BABEL_POOL.warm()
+
+
+def configure_babel_pool(size=None, processes=False, babel_js=None):
+    """Replace the pool of BabelJS interpreters used by
+    :func:`babel_compile` with a new one of the given `size`, optionally
+    backed by worker processes and loading the given `babel_js`
+    bundle. See :class:`BabelPool`.
+    """
+    global BABEL_POOL
+    with BABEL_POOL_LOCK:
+        old_pool = BABEL_POOL
+        BABEL_POOL = BabelPool(size, processes, babel_js)
+    if old_pool is not None:
+        old_pool.close()
+    return BABEL_POOL
+
+
+def get_babel_pool():
+    """Return the pool of BabelJS interpreters used by
+    :func:`babel_compile`, creating it if needed."""
+    global BABEL_POOL
+    if BABEL_POOL is None:
+        with BABEL_POOL_LOCK:
+            if BABEL_POOL is None:
+                BABEL_POOL = BabelPool()
+    return BABEL_POOL
+
+
+BABEL_CACHE = None
+
+BABEL_CACHE_MAX_SIZE = 256 * 1024 * 1024
+"""Default maximum size in bytes of the BabelJS output cache."""
+
+
+def configure_babel_cache(directory=None, max_size=BABEL_CACHE_MAX_SIZE):
+    """Enable an on-disk cache of the results of :func:`babel_compile`,
+    keyed by the BabelJS bundle, the source and the options. It's stored
+    into `directory`, by default ``~/.cache/pj/babel``, and the least
+    recently used entries are removed when it grows over `max_size`
+    bytes. A `max_size` of ``0`` disables the cache. Return the new
+    cache.
+    """
+    global BABEL_CACHE
+    if max_size == 0:
+        BABEL_CACHE = None
+    else:
+        if directory is None:
+            directory = default_cache_dir('babel')
+        BABEL_CACHE = DiskCache(directory, max_size)
+    return BABEL_CACHE
+
+
+def get_babel_cache():
+    """Return the cache used by :func:`babel_compile` or ``None`` if it's
+    not enabled."""
+    return BABEL_CACHE
 
 
 def babel_compile(source, reuse_js_ctx=True, **kwargs):
-    """Compile the given `source` from ES6 to ES5 using Babeljs."""
-    global BABEL_JS_CTX
+    """Compile the given `source` from ES6 to ES5 using Babeljs.
+
+    When `reuse_js_ctx` is true, an interpreter with BabelJS already
+    loaded is taken from the pool returned by :func:`get_babel_pool`,
+    otherwise a new one is used and then thrown away. If the cache is
+    enabled with :func:`configure_babel_cache`, BabelJS is used only
+    when the result isn't already there.
+    """
     presets = kwargs.get('presets')
     if not presets:
         kwargs['presets'] = ["es2015"]
-    trans_code = ('var bres, res;'
-                  'bres = Babel.transform(dukpy.es6code, dukpy.babel_options);',
-                  'res = {map: bres.map, code: bres.code};')
-    if reuse_js_ctx and BABEL_JS_CTX:
-        result = BABEL_JS_CTX.evaljs(trans_code, es6code=source,
-                                     babel_options=kwargs)
+    cache = BABEL_CACHE
+    if cache is not None:
+        babel_js = get_babel_pool().babel_js if reuse_js_ctx else None
+        key = cache_key(_babel_digest(babel_js), source,
+                        sorted(kwargs.items()))
+        result = cache.get(key)
+        if result is not None:
+            return result
+    if reuse_js_ctx:
+        result = get_babel_pool().compile(source, **kwargs)
     else:
-        with open(BABEL_COMPILER, 'r', encoding='utf-8') as babel_js:
-            if reuse_js_ctx:
-                BABEL_JS_CTX = dukpy.JSInterpreter()
-                eval_fn = BABEL_JS_CTX.evaljs
-            else:
-                eval_fn = dukpy.evaljs
-            result = eval_fn(
-                (babel_js.read(),
-                 'var bres, res;'
-                 'bres = Babel.transform(dukpy.es6code, dukpy.babel_options);',
-                 'res = {map: bres.map, code: bres.code};'),
-                es6code=source,
-                babel_options=kwargs
-            )
+        result = dukpy.evaljs((_babel_source(),) + BABEL_TRANSFORM_CODE,
+                              es6code=source, babel_options=kwargs)
+    if cache is not None:
+        cache.set(key, result)
     return result
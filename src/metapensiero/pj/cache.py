@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- result caches
+# :Created:  dom 18 ott 2026 09:56:31 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+import abc
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    """Return an hex digest of the given parts, which can be strings,
+    bytes or anything with a stable ``repr()``."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        elif not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+def default_cache_dir(*parts):
+    """Return the path of a directory under the user's cache, by default
+    ``~/.cache/pj``."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return Path(base, 'pj', *parts)
+
+
+class Cache(abc.ABC):
+    """Base class of the caches, which map string keys to values and count
+    hits and misses."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored for `key` or ``None``."""
+        value = self._get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """Return the value stored for `key` or ``None``, without updating
+        the statistics."""
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        """Store `value` for `key`."""
+
+    def clear(self):
+        """Remove all the entries and reset the statistics."""
+        with self._lock:
+            self.hits = self.misses = 0
+
+    @abc.abstractmethod
+    def __len__(self):
+        """Return the number of entries."""
+
+    def stats(self):
+        """Return a dict with the number of hits, misses and entries."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self)}
+
+
+class MemoryCache(Cache):
+    """Keep up to `maxsize` values in memory, discarding the least recently
+    used ones. The values are returned as they are, so they must not be
+    modified."""
+
+    def __init__(self, maxsize=128):
+        super().__init__()
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def _get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache(Cache):
+    """Store the values as JSON files under `directory`, named after their
+    keys. When the total size exceeds `max_size` bytes the least recently
+    used entries are removed, the use being tracked with the modification
+    time of the files.
+
+    The values must be serializable as JSON, otherwise the `encode` and
+    `decode` functions can be given to convert them to and from something
+    that is. Unreadable entries are discarded.
+    """
+
+    SUFFIX = '.json'
+
+    def __init__(self, directory, max_size=None, encode=None, decode=None):
+        super().__init__()
+        self.directory = Path(directory)
+        self.max_size = max_size
+        self._encode = encode
+        self._decode = decode
+        self._size = None
+
+    def _path(self, key):
+        return self.directory / key[:2] / (key[2:] + self.SUFFIX)
+
+    def _entries(self):
+        return self.directory.glob('*/*' + self.SUFFIX)
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                value = json.load(f)
+            if self._decode is not None:
+                value = self._decode(value)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning("Discarding the unreadable cache entry '%s': %s",
+                        path, e)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def set(self, key, value):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name('%s.%d.%d.tmp' % (
+            path.name, os.getpid(), threading.get_ident()))
+        if self._encode is not None:
+            value = self._encode(value)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(value, f)
+        size = tmp_path.stat().st_size
+        try:
+            # an existing entry is replaced, only the difference counts
+            size -= path.stat().st_size
+        except OSError:
+            pass
+        os.replace(str(tmp_path), str(path))
+        if self.max_size is not None:
+            with self._lock:
+                if self._size is None:
+                    self._size = sum(p.stat().st_size
+                                     for p in self._entries())
+                else:
+                    self._size += size
+                if self._size > self.max_size:
+                    self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the total size is
+        within 90% of `max_size`."""
+        entries = []
+        for path in self._entries():
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, path))
+        entries.sort()
+        size = sum(e[1] for e in entries)
+        limit = self.max_size * 0.9
+        for mtime, esize, path in entries:
+            if size <= limit:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            size -= esize
+        self._size = size
+
+    def clear(self):
+        super().clear()
+        for path in self._entries():
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+
+    def __len__(self):
+        return sum(1 for p in self._entries())
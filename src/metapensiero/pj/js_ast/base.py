@@ -7,10 +7,16 @@
 #
 
 import inspect
+import threading
 
 from ..processor.util import Line, Part
 
 
+_serialization = threading.local()
+"""Keeps in ``results`` the nodes serialized in advance by the running
+serialization of the current thread, see :meth:`TargetNode.serialize`"""
+
+
 class TargetNode:
     """This is the common ancestor of all the JS AST nodes."""
 
@@ -24,6 +30,10 @@ class TargetNode:
     subclasses"""
     transformed_args = None
 
+    """If true, the children of this node are serialized one at a time when
+    it's the root of a serialization, see :meth:`serialize`"""
+    streamed = False
+
     def __init__(self, *args, **kwargs):
         self.args = args
         self.options = kwargs
@@ -81,9 +91,55 @@ class TargetNode:
         return result
 
     def serialize(self):
+        """Yield the lines and parts of this node. The nodes below it are
+        serialized in advance, bottom-up and using an explicit stack, so
+        that their ``emit()`` finds the results of the children ready and
+        the depth of the tree isn't bounded by the recursion limit.
+
+        The results are kept only by the running serialization and not on
+        the nodes, that may be shared, like the cached snippets.
+        """
+        results = getattr(_serialization, 'results', None)
+        serialized = None
+        if results is not None:
+            # the result is used only once, by the parent
+            serialized = results.pop(self, None)
+        if serialized is None:
+            if self.streamed:
+                serialized = self._serialize()
+            else:
+                serialized = self._serialize_subtree()
+        yield from serialized
+
+    def _serialize(self):
         for a in self.emit(*self.transformed_args, **self.options):
             yield from a.serialize()
 
+    def _serialize_subtree(self):
+        nodes = []
+        seen = set()
+        stack = [self.transformed_args]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, TargetNode):
+                if item.transformed_args is not None and item not in seen:
+                    seen.add(item)
+                    nodes.append(item)
+                    stack.append(item.transformed_args)
+            elif isinstance(item, (list, tuple)):
+                stack.extend(item)
+        results = {}
+        outer = getattr(_serialization, 'results', None)
+        _serialization.results = results
+        try:
+            # every node comes after its parent, so serialize them in
+            # reverse
+            for node in reversed(nodes):
+                results[node] = list(node._serialize())
+            return list(self._serialize())
+        finally:
+            _serialization.results = outer
+
 
 class JSNode(TargetNode):
     pass
@@ -15,6 +15,8 @@ from .statements import JSImport, JSVarStatement
 
 class JSStatements(JSNode):
 
+    streamed = True
+
     def __iadd__(self, other):
         self.transformed_args.extend(other.transformed_args)
         return self
@@ -58,6 +60,6 @@ class JSStatements(JSNode):
 
         return itertools.chain(others_first, imports, vars_, others_after)
 
-    def serialize(self):
+    def _serialize(self):
         for a in self.emit(self.reordered_args(self.transformed_args)):
             yield from self.lines(a.serialize(), delim=True)
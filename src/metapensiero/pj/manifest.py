@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- incremental build manifest
+# :Created:  dom 18 ott 2026 09:32:06 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from .api import pj_fingerprint, pj_version
+
+log = logging.getLogger(__name__)
+
+
+def file_digest(fname):
+    """Return the hex SHA1 digest of the contents of the given file."""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Keep track of the files compiled from the `src_dir` tree, so that a
+    rebuild can skip those whose content didn't change since the last
+    compilation. It is stored as a JSON file into `dst_dir` and is
+    valid only for the same pj version and sources and the same
+    `options`.
+    """
+
+    FILENAME = '.pj-manifest.json'
+
+    def __init__(self, dst_dir, src_dir, options):
+        self.dst_dir = Path(dst_dir)
+        self.src_dir = Path(src_dir)
+        self.path = self.dst_dir / self.FILENAME
+        self.options = options
+        self.valid = False
+        self.dirty = True
+        self.entries = {}
+        self._digests = {}
+        self.load()
+
+    def _key(self, src_fname):
+        return Path(src_fname).relative_to(self.src_dir).as_posix()
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        # keep the entries even if the manifest isn't valid, they are
+        # needed to remove the outputs of deleted sources
+        self.entries = data.get('files', {})
+        self.valid = (data.get('version') == pj_version() and
+                      data.get('fingerprint') == pj_fingerprint() and
+                      data.get('options') == self.options)
+        self.dirty = not self.valid
+
+    def save(self):
+        data = {'version': pj_version(),
+                'fingerprint': pj_fingerprint(),
+                'options': self.options,
+                'files': self.entries}
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(str(tmp_path), str(self.path))
+        self.valid = True
+        self.dirty = False
+
+    def is_stale(self, src_fname):
+        """Return ``True`` if the given source has to be compiled again."""
+        key = self._key(src_fname)
+        entry = self.entries.get(key)
+        if not self.valid or entry is None:
+            return True
+        if not all((self.dst_dir / o).exists() for o in entry['outputs']):
+            return True
+        try:
+            st = os.stat(src_fname)
+        except OSError:
+            return True
+        if entry['size'] == st.st_size and entry['mtime'] == st.st_mtime_ns:
+            return False
+        digest = self._digests[key] = file_digest(src_fname)
+        if digest != entry['hash']:
+            return True
+        # just touched
+        entry['mtime'] = st.st_mtime_ns
+        self.dirty = True
+        return False
+
+    def record(self, src_fname, outputs):
+        """Record the successful compilation of a source into `outputs`."""
+        key = self._key(src_fname)
+        try:
+            st = os.stat(src_fname)
+            digest = self._digests.pop(key, None) or file_digest(src_fname)
+        except OSError:
+            # removed after its compilation
+            self.discard(src_fname)
+            return
+        self.entries[key] = {
+            'hash': digest,
+            'size': st.st_size,
+            'mtime': st.st_mtime_ns,
+            'outputs': [Path(os.path.relpath(o, str(self.dst_dir))).as_posix()
+                        for o in outputs]
+        }
+        self.dirty = True
+
+    def discard(self, src_fname):
+        """Forget a source, usually because its compilation failed."""
+        if self.entries.pop(self._key(src_fname), None) is not None:
+            self.dirty = True
+
+    def prune(self, src_fnames):
+        """Remove the outputs of the recorded sources that aren't in
+        `src_fnames` anymore, returning the removed files."""
+        keep = {self._key(s) for s in src_fnames}
+        removed = []
+        for key in sorted(set(self.entries) - keep):
+            removed.extend(self._remove(key))
+        return removed
+
+    def remove(self, src_fname):
+        """Forget a source that doesn't exist anymore and remove its
+        outputs, returning the removed files."""
+        key = self._key(src_fname)
+        self._digests.pop(key, None)
+        return self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return []
+        self.dirty = True
+        removed = []
+        for o in entry['outputs']:
+            opath = self.dst_dir / o
+            if opath.exists():
+                opath.unlink()
+                removed.append(opath)
+        return removed
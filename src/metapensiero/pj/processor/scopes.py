@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- scope analysis
+# :Created:  dom 18 ott 2026 10:09:28 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+import ast
+
+from ..compat import assign_types
+from .util import CODE_BLOCK_STMTS, node_names
+
+
+YIELD = 1
+AWAIT = 2
+RETURN = 4
+RAISE = 8
+
+FEATURES = {
+    ast.Yield: YIELD,
+    ast.YieldFrom: YIELD,
+    ast.Await: AWAIT,
+    ast.Return: RETURN,
+    ast.Raise: RAISE,
+}
+"""The statements and expressions whose presence is tracked by the
+analysis."""
+
+FUNCTION_STMTS = (ast.FunctionDef, ast.AsyncFunctionDef)
+
+LEAF_NODES = (ast.expr_context, ast.boolop, ast.operator, ast.unaryop,
+              ast.cmpop)
+"""The nodes without fields that the parser shares between all their
+occurrences, and that are not walked into by the analysis."""
+
+_NAME, _ARG, _ALIAS, _BLOCK, _HANDLER, _ASSIGN, _GLOBAL, _OTHER = range(8)
+
+_node_info = {}
+
+
+def _class_info(cls):
+    """Compute and cache the facts about the node class `cls` that are used
+    by the analysis, to avoid repeating the ``isinstance()`` checks for
+    every node."""
+    if issubclass(cls, ast.Name):
+        kind = _NAME
+    elif issubclass(cls, ast.arg):
+        kind = _ARG
+    elif issubclass(cls, ast.alias):
+        kind = _ALIAS
+    elif issubclass(cls, CODE_BLOCK_STMTS):
+        kind = _BLOCK
+    elif issubclass(cls, ast.ExceptHandler):
+        kind = _HANDLER
+    elif issubclass(cls, assign_types):
+        kind = _ASSIGN
+    elif issubclass(cls, (ast.Global, ast.Nonlocal)):
+        kind = _GLOBAL
+    else:
+        kind = _OTHER
+    fields = tuple(f for f in cls._fields if f != 'ctx')
+    info = _node_info[cls] = (kind, FEATURES.get(cls, 0), fields)
+    return info
+
+
+class Scope:
+    """The facts known about a code block, i.e. the module, a function or a
+    class. The `local_names` are those assigned to in the block, without
+    descending into the nested ones. The `features` are a bitmask of the
+    ``FEATURES`` found in its body.
+    """
+
+    __slots__ = ('node', 'parent', 'local_names', 'globals', 'features',
+                 'enclosing_function', 'enclosing_class')
+
+    def __init__(self, node, parent=None):
+        self.node = node
+        self.parent = parent
+        self.local_names = set()
+        self.globals = set()
+        self.features = 0
+        if parent is None:
+            self.enclosing_function = self.enclosing_class = None
+        else:
+            self.enclosing_function = (
+                parent.node if isinstance(parent.node, FUNCTION_STMTS)
+                else parent.enclosing_function)
+            self.enclosing_class = (
+                parent.node if isinstance(parent.node, ast.ClassDef)
+                else parent.enclosing_class)
+
+    @property
+    def is_async(self):
+        return isinstance(self.node, ast.AsyncFunctionDef)
+
+    @property
+    def is_generator(self):
+        return bool(self.features & YIELD)
+
+    @property
+    def has_await(self):
+        return bool(self.features & AWAIT)
+
+    @property
+    def has_return(self):
+        return bool(self.features & RETURN)
+
+    @property
+    def has_raise(self):
+        return bool(self.features & RAISE)
+
+
+class ScopeAnalysis:
+    """Analyze the tree under `top` with a single walk, collecting the
+    parent of every node, the `Scope` of every code block, the
+    ``FEATURES`` found under every node, without descending into nested
+    code blocks, and all the identifiers used by the code.
+    """
+
+    def __init__(self, top):
+        self.parents = {}
+        self.scopes = {}
+        self.features = {}
+        self.names = set()
+        self._analyze(top)
+
+    def _analyze(self, top):
+        parents = self.parents
+        scopes = self.scopes
+        names = self.names
+        node_info = _node_info
+        scopes[top] = scope = Scope(top)
+        stack = [(top, scope)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, scope = pop()
+            cls = node.__class__
+            info = node_info.get(cls)
+            if info is None:
+                info = _class_info(cls)
+            kind, flag, fields = info
+            if kind == _NAME:
+                names.add(node.id)
+            elif kind == _ARG:
+                names.add(node.arg)
+            elif kind == _ALIAS:
+                names.add((node.asname or node.name).split('.')[0])
+            elif kind == _BLOCK or kind == _HANDLER:
+                if node.name:
+                    names.add(node.name)
+            elif kind == _ASSIGN:
+                scope.local_names |= node_names(node)
+            elif kind == _GLOBAL:
+                scope.globals.update(node.names)
+                names.update(node.names)
+            elif flag:
+                scope.features |= flag
+                self._mark(node, flag)
+            inner = None
+            if kind == _BLOCK and node is not top:
+                inner = scopes[node] = Scope(node, scope)
+            for field in fields:
+                value = getattr(node, field, None)
+                child_scope = inner if inner is not None and \
+                    field == 'body' else scope
+                if isinstance(value, (list, tuple)):
+                    for child in value:
+                        if isinstance(child, ast.AST) and \
+                           not isinstance(child, LEAF_NODES):
+                            parents[child] = node
+                            push((child, child_scope))
+                elif isinstance(value, ast.AST) and \
+                        not isinstance(value, LEAF_NODES):
+                    parents[value] = node
+                    push((value, child_scope))
+        for scope in scopes.values():
+            scope.local_names -= scope.globals
+
+    def _mark(self, node, flag):
+        """Mark `node` and its parents up to the enclosing code block as
+        containing `flag`. The nodes are visited parents first, so the walk
+        can stop at the first one already marked."""
+        features = self.features
+        parents = self.parents
+        while node is not None:
+            current = features.get(node, 0)
+            if current & flag:
+                break
+            features[node] = current | flag
+            if isinstance(node, CODE_BLOCK_STMTS):
+                break
+            node = parents.get(node)
+
+    def contains(self, nodes, cls):
+        """Return true if any of `nodes` is or contains, without descending
+        into nested code blocks, an instance of `cls`, that must be one of
+        the ``FEATURES`` or a tuple of them. Return ``None`` if `cls` isn't
+        tracked or any of `nodes` wasn't analyzed."""
+        if not isinstance(cls, tuple):
+            cls = (cls,)
+        flag = 0
+        for c in cls:
+            if c not in FEATURES:
+                return None
+            flag |= FEATURES[c]
+        parents = self.parents
+        for node in nodes:
+            if node not in parents and node not in self.scopes:
+                return None
+        for node in nodes:
+            if isinstance(node, CODE_BLOCK_STMTS):
+                if isinstance(node, cls):
+                    return True
+            elif self.features.get(node, 0) & flag:
+                return True
+        return False
@@ -30,11 +30,16 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+from array import array
 from base64 import b64encode
-from bisect import bisect_right
-from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict
+from itertools import accumulate, islice, repeat
 import json
+from operator import add, lt, mul
+import os
 import re
+import threading
 
 
 # A single base 64 digit can contain 6 bits of data. For the base 64
@@ -62,6 +67,16 @@ VLQ_CONTINUATION_BIT = VLQ_BASE
 BASE64_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
 BASE64_CHAR_TO_INT = dict(map(reversed, enumerate(BASE64_CHARS)))
 
+# byte value -> base 64 digit, -1 for invalid chars
+BASE64_DECODE_TABLE = [-1] * 256
+for ix, c in enumerate(BASE64_CHARS):
+    BASE64_DECODE_TABLE[ord(c)] = ix
+del ix, c
+
+# the encoded form of the numbers in [-VLQ_TABLE_SIZE, VLQ_TABLE_SIZE) is
+# precomputed, deltas outside of this range are rare
+VLQ_TABLE_SIZE = 1 << 12
+
 
 class SourceMapDecodeError(ValueError):
     pass
@@ -76,23 +91,21 @@ def decode_vlqs(segment):
     """
 
     values = []
+    table = BASE64_DECODE_TABLE
 
     vlq = shift = 0
-    for c in segment:
-        val = BASE64_CHAR_TO_INT[c]
-        cont = val & VLQ_CONTINUATION_BIT
+    for c in segment.encode('latin-1', 'replace'):
+        val = table[c]
+        if val < 0:
+            raise SourceMapDecodeError('invalid char in vlq: %r' % segment)
         # Each character is 6 bits:
         # 5 of value and the high bit is the continuation.
-        val &= VLQ_BASE_MASK
-        vlq += val << shift
+        vlq += (val & VLQ_BASE_MASK) << shift
         shift += VLQ_BASE_SHIFT
 
-        if not cont:
+        if not val & VLQ_CONTINUATION_BIT:
             # The low bit of the unpacked value is the sign.
-            vlq, sign = vlq >> 1, vlq & 1
-            if sign:
-                vlq = -vlq
-            values.append(vlq)
+            values.append(-(vlq >> 1) if vlq & 1 else vlq >> 1)
             vlq = shift = 0
 
     if vlq or shift:
@@ -101,17 +114,149 @@ def decode_vlqs(segment):
     return values
 
 
-def encode_vlq(num):
-    """Encode a single number in VLQ format"""
+def _encode_vlq(num):
     vlq = (-num << 1) + 1 if num < 0 else num << 1
-    result = ''
-    while not result or vlq > 0:
+    digits = []
+    while not digits or vlq > 0:
         digit = vlq & VLQ_BASE_MASK
         vlq >>= VLQ_BASE_SHIFT
         if vlq > 0:
             digit |= VLQ_CONTINUATION_BIT
-        result += BASE64_CHARS[digit]
-    return result
+        digits.append(BASE64_CHARS[digit])
+    return ''.join(digits)
+
+
+VLQ_TABLE = [_encode_vlq(n) for n in range(-VLQ_TABLE_SIZE, VLQ_TABLE_SIZE)]
+
+
+def encode_vlq(num):
+    """Encode a single number in VLQ format"""
+    if -VLQ_TABLE_SIZE <= num < VLQ_TABLE_SIZE:
+        return VLQ_TABLE[num + VLQ_TABLE_SIZE]
+    return _encode_vlq(num)
+
+
+def encode_vlqs(values):
+    """Encode a sequence of numbers in VLQ format."""
+    return ''.join(map(encode_vlq, values))
+
+
+def encode_mappings(dst_lines, dst_cols, src_ids, src_lines, src_cols,
+                    name_ids):
+    """Encode the segments given as parallel sequences of absolute values,
+    sorted by destination position, into the ``mappings`` field of a source
+    map. A negative `src_ids` item means that the segment has no source, a
+    negative `name_ids` item that it has no name.
+    """
+    return ''.join(iter_encode_mappings(dst_lines, dst_cols, src_ids,
+                                        src_lines, src_cols, name_ids))
+
+
+def iter_encode_mappings(dst_lines, dst_cols, src_ids, src_lines, src_cols,
+                         name_ids):
+    """Like :func:`encode_mappings`, but produce the ``mappings`` field a
+    line at a time."""
+    table = VLQ_TABLE
+    size = VLQ_TABLE_SIZE
+    segments = []
+    cur_line = 0
+    prev_dst_col = prev_src_id = prev_src_line = prev_src_col = 0
+    prev_name_id = 0
+    for dst_line, dst_col, src_id, src_line, src_col, name_id in zip(
+            dst_lines, dst_cols, src_ids, src_lines, src_cols, name_ids):
+        if dst_line != cur_line:
+            yield ','.join(segments) + ';' * (dst_line - cur_line)
+            segments = []
+            cur_line = dst_line
+            prev_dst_col = 0
+        n = dst_col - prev_dst_col + size
+        seg = table[n] if 0 <= n < 2 * size else _encode_vlq(n - size)
+        prev_dst_col = dst_col
+        if src_id >= 0:
+            n = src_id - prev_src_id + size
+            seg += table[n] if 0 <= n < 2 * size else _encode_vlq(n - size)
+            n = src_line - prev_src_line + size
+            seg += table[n] if 0 <= n < 2 * size else _encode_vlq(n - size)
+            n = src_col - prev_src_col + size
+            seg += table[n] if 0 <= n < 2 * size else _encode_vlq(n - size)
+            if name_id >= 0:
+                n = name_id - prev_name_id + size
+                seg += (table[n] if 0 <= n < 2 * size
+                        else _encode_vlq(n - size))
+                prev_name_id = name_id
+            prev_src_id = src_id
+            prev_src_line = src_line
+            prev_src_col = src_col
+        segments.append(seg)
+    yield ','.join(segments)
+
+
+def _segment_deltas(segment):
+    fields = decode_vlqs(segment)
+    nfields = len(fields)
+    if nfields not in (1, 4, 5):
+        raise SourceMapDecodeError(
+            'Invalid segment {}, parsed as {}'.format(segment, fields))
+    return tuple(fields) + (0,) * (5 - nfields) + (nfields,)
+
+
+class _SegmentCache(dict):
+    """Map the text of a segment to the tuple of its five relative fields,
+    padded with zeros, followed by the number of fields actually
+    present. Segments repeat a lot in a source map."""
+
+    def __missing__(self, segment):
+        value = self[segment] = _segment_deltas(segment)
+        return value
+
+
+def decode_mappings(mappings):
+    """Decode the ``mappings`` field of a source map into six
+    ``array('i')``, one for each field of the segments, with absolute
+    values. Segments without a source have ``-1`` as source id and those
+    without a name have ``-1`` as name id.
+    """
+    lookup = _SegmentCache().__getitem__
+    deltas = []
+    line_lengths = []
+    for line in mappings.split(';'):
+        if line:
+            line_deltas = list(map(lookup, filter(None, line.split(','))))
+            deltas.extend(line_deltas)
+            line_lengths.append(len(line_deltas))
+        else:
+            line_lengths.append(0)
+    if not deltas:
+        return tuple(array('i') for i in range(6))
+    dcols, dsrc_ids, dsrc_lines, dsrc_cols, dname_ids, nfields = zip(*deltas)
+
+    dst_lines = array('i')
+    dst_cols = array('i')
+    pos = 0
+    for dst_line, length in enumerate(line_lengths):
+        if length:
+            dst_lines.extend(repeat(dst_line, length))
+            # columns are relative to the previous segment on the same line
+            dst_cols.extend(accumulate(dcols[pos:pos + length]))
+            pos += length
+    src_ids = array('i', accumulate(dsrc_ids))
+    src_lines = array('i', accumulate(dsrc_lines))
+    src_cols = array('i', accumulate(dsrc_cols))
+    name_ids = array('i', accumulate(dname_ids))
+    for name, column in (('dst_col', dst_cols), ('source', src_ids),
+                         ('src_line', src_lines), ('src_col', src_cols),
+                         ('name', name_ids)):
+        if min(column) < 0:
+            raise SourceMapDecodeError(
+                'Segment {} has negative {}'.format(
+                    column.index(min(column)), name))
+    if 1 in nfields:
+        src_ids = array('i', [i if n > 1 else -1
+                              for i, n in zip(src_ids, nfields)])
+    if 1 in nfields or 4 in nfields:
+        name_ids = array('i', [i if n == 5 else -1
+                               for i, n in zip(name_ids, nfields)])
+    return dst_lines, dst_cols, src_ids, src_lines, src_cols, name_ids
 
 
 source_map_url_re = re.compile(
@@ -144,13 +289,13 @@ def strip(content):
 # namedtuples have a nice repr and they support comparison (useful for
 # bisect search)
 class Token(namedtuple('TokenBase', 'dst_line dst_col src src_line src_col '
-                       'name mapping')):
+                       'name')):
     __slots__ = ()
 
     def __new__(cls, dst_line=0, dst_col=0, src='', src_line=0, src_col=0,
-                name=None, mapping=None):
+                name=None):
         return super(Token, cls).__new__(cls, dst_line, dst_col,
-                                         src, src_line, src_col, name, mapping)
+                                         src, src_line, src_col, name)
 
 
 def shift_tokens(tokens, dst_line=0, dst_col=0, src_line=0, src_col=0):
@@ -200,29 +345,268 @@ def identity_map(content, src):
 
 
 class SourceMap:
+    """A source map. The segments are kept in parallel integer arrays, one
+    for each field, with the sources and the names interned in two tables.
+    `tokens` gives a view of them as :class:`Token` instances.
+
+    Segments can be added in any order, they are sorted only once when
+    needed.
+    """
+
     def __init__(self, tokens=(), sources_content=None, raw=None,
-                 ignore_errors=False):
-        self.tokens = []
+                 ignore_errors=False, file=None):
+        self.dst_lines = array('i')
+        self.dst_cols = array('i')
+        self.src_ids = array('i')
+        self.src_lines = array('i')
+        self.src_cols = array('i')
+        self.name_ids = array('i')
+        self.sources = []
+        self._source_ids = {}
+        self.names = []
+        self._name_ids = {}
+        self._sorted = True
+        self._line_index = None
+        self._source_index = None
         if sources_content is None:
             self.sources_content = {}
         else:
             self.sources_content = sources_content.copy()
         self.raw = {} if raw is None else raw.copy()
         self.ignore_errors = ignore_errors
-        map(self.add_token, tokens)
+        self.file = file
+        for token in tokens:
+            self.add_token(token)
+
+    def __len__(self):
+        return len(self.dst_lines)
+
+    def source_id(self, src):
+        """Return the index of `src` in the sources table, adding it if
+        needed. ``None`` is mapped to ``-1``."""
+        if src is None:
+            return -1
+        src_id = self._source_ids.get(src)
+        if src_id is None:
+            src_id = self._source_ids[src] = len(self.sources)
+            self.sources.append(src)
+        return src_id
+
+    def name_id(self, name):
+        """Return the index of `name` in the names table, adding it if
+        needed. ``None`` is mapped to ``-1``."""
+        if name is None:
+            return -1
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def add_segment(self, dst_line, dst_col, src_id=-1, src_line=0,
+                    src_col=0, name_id=-1):
+        """Add a segment whose source and name are already interned."""
+        dst_lines = self.dst_lines
+        if self._sorted and dst_lines:
+            last_line = dst_lines[-1]
+            if dst_line < last_line or (dst_line == last_line and
+                                        dst_col <= self.dst_cols[-1]):
+                if (dst_line == last_line and dst_col == self.dst_cols[-1]
+                    and not self.ignore_errors):
+                    raise ValueError(
+                        'Token with given dst_line and dst_col already '
+                        'exists:\nExisting: {}\nAdded: {}'.format(
+                            self._token(len(dst_lines) - 1),
+                            Token(dst_line, dst_col,
+                                  self.sources[src_id] if src_id >= 0
+                                  else None,
+                                  src_line, src_col,
+                                  self.names[name_id] if name_id >= 0
+                                  else None)))
+                self._sorted = False
+        dst_lines.append(dst_line)
+        self.dst_cols.append(dst_col)
+        self.src_ids.append(src_id)
+        self.src_lines.append(src_line)
+        self.src_cols.append(src_col)
+        self.name_ids.append(name_id)
+
+    def add_mapping(self, dst_line, dst_col, src=None, src_line=0, src_col=0,
+                    name=None):
+        """Add a segment."""
+        self.add_segment(dst_line, dst_col, self.source_id(src), src_line,
+                         src_col, self.name_id(name))
 
     def add_token(self, token):
-        if not self.tokens or token[:2] > self.tokens[-1][:2]:
-            self.tokens.append(token)
+        self.add_mapping(*token)
+
+    def finalize(self):
+        """Sort the segments by destination position, if needed."""
+        if self._sorted:
+            return
+        dst_lines = self.dst_lines
+        dst_cols = self.dst_cols
+        order = sorted(range(len(dst_lines)),
+                       key=lambda i: (dst_lines[i], dst_cols[i]))
+        if not self.ignore_errors:
+            for a, b in zip(order, order[1:]):
+                if dst_lines[a] == dst_lines[b] and dst_cols[a] == dst_cols[b]:
+                    raise ValueError(
+                        'Token with given dst_line and dst_col already '
+                        'exists:\nExisting: {}\nAdded: {}'.format(
+                            self._token(a), self._token(b)))
+        for name in ('dst_lines', 'dst_cols', 'src_ids', 'src_lines',
+                     'src_cols', 'name_ids'):
+            column = getattr(self, name)
+            setattr(self, name, array('i', [column[i] for i in order]))
+        self._sorted = True
+        self._line_index = None
+        self._source_index = None
+
+    def _token(self, ix):
+        src_id = self.src_ids[ix]
+        name_id = self.name_ids[ix]
+        return Token(self.dst_lines[ix], self.dst_cols[ix],
+                     self.sources[src_id] if src_id >= 0 else None,
+                     self.src_lines[ix], self.src_cols[ix],
+                     self.names[name_id] if name_id >= 0 else None)
+
+    @property
+    def tokens(self):
+        """The segments as a list of :class:`Token`, sorted by destination
+        position."""
+        self.finalize()
+        return [self._token(ix) for ix in range(len(self.dst_lines))]
+
+    def _line_offsets(self):
+        """Return an array with the index of the first segment of every
+        destination line, followed by the number of segments. It is
+        built when needed and kept until new segments are added."""
+        self.finalize()
+        index = self._line_index
+        if index is None or index[0] != len(self):
+            dst_lines = self.dst_lines
+            nlines = dst_lines[-1] + 1 if dst_lines else 0
+            index = self._line_index = (len(self), array('i', map(
+                bisect_left, repeat(dst_lines), range(nlines + 1))))
+        return index[1]
+
+    def _find_segment(self, dst_line, dst_col):
+        """Return the index of the segment covering the given destination
+        position, that is the last one on `dst_line` starting at or before
+        `dst_col`, or ``-1`` if there is none."""
+        offsets = self._line_offsets()
+        if not 0 <= dst_line < len(offsets) - 1:
+            return -1
+        lo = offsets[dst_line]
+        ix = bisect_right(self.dst_cols, dst_col, lo,
+                          offsets[dst_line + 1]) - 1
+        return ix if ix >= lo else -1
+
+    def lookup(self, dst_line, dst_col):
+        """Return the :class:`Token` of the segment covering the given
+        position in the generated code, or ``None``. Both are 0-based."""
+        ix = self._find_segment(dst_line, dst_col)
+        return self._token(ix) if ix >= 0 else None
+
+    def _source_positions(self, src_id):
+        """Return the positions in the source `src_id`, encoded as
+        ``src_line << 32 | src_col`` and sorted, together with the
+        indexes of their segments."""
+        self.finalize()
+        index = self._source_index
+        if index is None or index[0] != len(self):
+            by_source = {}
+            for ix, (sid, src_line, src_col) in enumerate(zip(
+                    self.src_ids, self.src_lines, self.src_cols)):
+                if sid >= 0:
+                    by_source.setdefault(sid, []).append(
+                        ((src_line << 32) | src_col, ix))
+            for sid, positions in by_source.items():
+                positions.sort()
+                by_source[sid] = (array('q', [p[0] for p in positions]),
+                                  array('i', [p[1] for p in positions]))
+            index = self._source_index = (len(self), by_source)
+        return index[1].get(src_id, (array('q'), array('i')))
+
+    def lookup_source(self, src, src_line, src_col=None):
+        """Return the tokens of the segments generated from the given
+        position of the `src` source, that is the last one on `src_line`
+        starting at or before `src_col`, sorted by destination position.
+        If `src_col` is ``None`` return those of the whole line.
+        """
+        src_id = self._source_ids.get(src)
+        if src_id is None:
+            return []
+        keys, ixs = self._source_positions(src_id)
+        if src_col is None:
+            lo = bisect_left(keys, src_line << 32)
+            hi = bisect_left(keys, (src_line + 1) << 32)
         else:
-            index = bisect_right(self.tokens, token)
-            if not self.ignore_errors and index and \
-                    self.tokens[index - 1][:2] == token[:2]:
-                raise ValueError(
-                    'Token with given dst_line and dst_col already exists:\n'
-                    'Existing: {}\nAdded: {}'.format(self.tokens[index - 1],
-                                                     token))
-            self.tokens.insert(index, token)
+            hi = bisect_right(keys, (src_line << 32) | src_col)
+            if not hi or keys[hi - 1] >> 32 != src_line:
+                return []
+            lo = bisect_left(keys, keys[hi - 1], 0, hi)
+        return [self._token(ix) for ix in sorted(ixs[lo:hi])]
+
+    @classmethod
+    def compose(cls, outer, inner, source=None):
+        """Chain two maps, returning a new map that goes from the
+        destination of `outer` directly to the sources of `inner`. This
+        is what is needed when the output of a translation is processed
+        again by another tool, like BabelJS or a minifier, `inner` being
+        the map of the first step and `outer` that of the second.
+
+        If `source` is given, only the segments of `outer` that refer to
+        it are remapped and the others are kept as they are, otherwise
+        all of them are remapped. Segments that have no correspondence
+        in `inner` are kept without a source, as the unmapped segments
+        of `outer`. The `file` of the result is that of `outer`.
+        """
+        outer.finalize()
+        inner.finalize()
+        result = cls(file=outer.file)
+        inner_src_ids = [result.source_id(s) for s in inner.sources]
+        outer_src_ids = {}
+        keep_id = -1 if source is None else outer._source_ids.get(source, -2)
+        find_segment = inner._find_segment
+        for (dst_line, dst_col, src_id, src_line, src_col,
+             name_id) in zip(outer.dst_lines, outer.dst_cols, outer.src_ids,
+                             outer.src_lines, outer.src_cols, outer.name_ids):
+            if src_id < 0:
+                result.add_segment(dst_line, dst_col)
+                continue
+            if keep_id != -1 and src_id != keep_id:
+                new_src_id = outer_src_ids.get(src_id)
+                if new_src_id is None:
+                    new_src_id = outer_src_ids[src_id] = result.source_id(
+                        outer.sources[src_id])
+                result.add_segment(
+                    dst_line, dst_col, new_src_id, src_line, src_col,
+                    result.name_id(outer.names[name_id]) if name_id >= 0
+                    else -1)
+                continue
+            ix = find_segment(src_line, src_col)
+            if ix < 0 or inner.src_ids[ix] < 0:
+                result.add_segment(dst_line, dst_col)
+                continue
+            inner_name_id = inner.name_ids[ix]
+            # a name applies only where its segment starts
+            if inner_name_id >= 0 and inner.dst_cols[ix] == src_col:
+                name = inner.names[inner_name_id]
+            elif name_id >= 0:
+                name = outer.names[name_id]
+            else:
+                name = None
+            result.add_segment(dst_line, dst_col,
+                               inner_src_ids[inner.src_ids[ix]],
+                               inner.src_lines[ix], inner.src_cols[ix],
+                               result.name_id(name))
+        for sources_content in (outer.sources_content, inner.sources_content):
+            for src, content in sources_content.items():
+                if src in result._source_ids:
+                    result.sources_content[src] = content
+        return result
 
     @classmethod
     def decode(cls, source, ignore_errors=True):
@@ -237,69 +621,130 @@ class SourceMap:
                 source = source.split('\n', 1)[1]
             smap = json.loads(source)
 
+        if 'sections' in smap:
+            return cls._decode_index(smap, ignore_errors)
+
         sources = smap['sources']
         names = list(map(str, smap['names']))
-        lines = smap['mappings'].split(';')
 
         source_root = smap.get('source_root')
         if source_root is not None:
             sources = ['/'.join((source_root, s)) for s in sources]
 
-        tokens = []
-
-        dst_col = src_id = src_line = src_col = name_id = 0
-        for dst_line, line in enumerate(lines):
-            dst_col = 0
-            for segment in line.split(','):
-                if not segment:
-                    continue
-                fields = decode_vlqs(segment)
-                dst_col += fields[0]
-                if dst_col < 0:
-                    raise SourceMapDecodeError(
-                        'Segment {} has negative dst_col'.format(segment, fields))
-
-                src = None
-                name = None
-                if len(fields) not in (1, 4, 5):
-                    raise SourceMapDecodeError(
-                        'Invalid segment {}, parsed as {}'.format(segment, fields))
-                if len(fields) > 1:
-                    src_id += fields[1]
-                    if not 0 <= src_id < len(sources):
-                        raise SourceMapDecodeError(
-                            'Segment {} references source {} which '
-                            'does not exist'.format(
-                                segment, src_id))
-                    src = sources[src_id]
-                    src_line += fields[2]
-                    if src_line < 0:
-                        raise SourceMapDecodeError(
-                            'Segment {} has negative src_line'.format(segment))
-                    src_col += fields[3]
-                    if src_col < 0:
-                        raise SourceMapDecodeError(
-                            'Segment {} has negative src_col'.format(segment))
-
-                if len(fields) > 4:
-                    name_id += fields[4]
-                    if not 0 <= name_id < len(names):
-                        raise SourceMapDecodeError(
-                            'Segment {} references name {} which '
-                            'does not exist'.format(
-                                segment, name_id))
-                    name = names[name_id]
-
-                tokens.append(Token(dst_line, dst_col, src, src_line, src_col,
-                                    name))
-
         sources_content = {src: content
                            for src, content in zip(
                                    sources, smap.get('sourcesContent',
                                                      (None,) * len(sources)))
                            if content is not None}
-        return cls(tokens, sources_content, raw=smap,
-                         ignore_errors=ignore_errors)
+        result = cls(sources_content=sources_content, raw=smap,
+                     ignore_errors=ignore_errors, file=smap.get('file'))
+        (dst_lines, dst_cols, src_ids, src_lines, src_cols,
+         name_ids) = decode_mappings(smap['mappings'])
+        if src_ids and max(src_ids) >= len(sources):
+            raise SourceMapDecodeError(
+                'A segment references source {} which does not '
+                'exist'.format(max(src_ids)))
+        if name_ids and max(name_ids) >= len(names):
+            raise SourceMapDecodeError(
+                'A segment references name {} which does not '
+                'exist'.format(max(name_ids)))
+        # intern the tables, which may contain duplicates
+        src_remap = [result.source_id(src) for src in sources]
+        name_remap = [result.name_id(name) for name in names]
+        if len(result.sources) < len(sources):
+            src_ids = array('i', [src_remap[i] if i >= 0 else -1
+                                  for i in src_ids])
+        if len(result.names) < len(names):
+            name_ids = array('i', [name_remap[i] if i >= 0 else -1
+                                   for i in name_ids])
+        result.dst_lines = dst_lines
+        result.dst_cols = dst_cols
+        result.src_ids = src_ids
+        result.src_lines = src_lines
+        result.src_cols = src_cols
+        result.name_ids = name_ids
+        # decoded lines are already in order, the segments need sorting
+        # only if some column goes backwards
+        positions = list(map(add, map(mul, dst_lines, repeat(1 << 32)),
+                             dst_cols))
+        result._sorted = all(map(lt, positions, islice(positions, 1, None)))
+        result.finalize()
+        return result
+
+    @classmethod
+    def _decode_index(cls, smap, ignore_errors):
+        """Decode an *index map*, whose sections contain the maps of the
+        parts of the generated code."""
+        result = cls(raw=smap, ignore_errors=ignore_errors,
+                     file=smap.get('file'))
+        for section in smap['sections']:
+            if 'map' not in section:
+                raise SourceMapDecodeError(
+                    'Sections referring to an url are not supported')
+            offset = section['offset']
+            result.extend(cls.decode(section['map'], ignore_errors),
+                          offset['line'], offset['column'])
+        result.finalize()
+        return result
+
+    def extend(self, other, dst_line=0, dst_col=0):
+        """Append the segments of the `other` map, moving them to start at
+        the given destination position. As for the sections of an index
+        map, `dst_col` is added only to the segments on the first line.
+        """
+        other.finalize()
+        count = bisect_left(other.dst_lines, 1)
+        if len(self) and len(other) and (
+                (dst_line + other.dst_lines[0], other.dst_cols[0] +
+                 (dst_col if count else 0)) <=
+                (self.dst_lines[-1], self.dst_cols[-1])):
+            self._sorted = False
+        self.dst_lines.extend(map(add, other.dst_lines, repeat(dst_line)))
+        self.dst_cols.extend(map(add, other.dst_cols[:count],
+                                 repeat(dst_col)))
+        self.dst_cols.extend(other.dst_cols[count:])
+        src_remap = [self.source_id(src) for src in other.sources]
+        name_remap = [self.name_id(name) for name in other.names]
+        for column, other_column, remap in (
+                (self.src_ids, other.src_ids, src_remap),
+                (self.name_ids, other.name_ids, name_remap)):
+            if remap == list(range(len(remap))):
+                column.extend(other_column)
+            else:
+                column.extend([remap[i] if i >= 0 else -1
+                               for i in other_column])
+        self.src_lines.extend(other.src_lines)
+        self.src_cols.extend(other.src_cols)
+        for src, content in other.sources_content.items():
+            self.sources_content.setdefault(src, content)
+
+    def _encoded_tables(self):
+        """Return the sources and names that are actually used, numbered in
+        order of appearance, and the ids of the segments remapped to
+        them. Names are emitted only on segments with a source."""
+        self.finalize()
+        sources = {}
+        names = {}
+        src_ids = array('i')
+        name_ids = array('i')
+        for src_ix, name_ix in zip(self.src_ids, self.name_ids):
+            if src_ix < 0:
+                src_ids.append(-1)
+                name_ids.append(-1)
+                continue
+            source_id = sources.get(src_ix)
+            if source_id is None:
+                source_id = sources[src_ix] = len(sources)
+            src_ids.append(source_id)
+            if name_ix >= 0 and self.names[name_ix]:
+                name_id = names.get(name_ix)
+                if name_id is None:
+                    name_id = names[name_ix] = len(names)
+                name_ids.append(name_id)
+            else:
+                name_ids.append(-1)
+        return ([self.sources[ix] for ix in sources],
+                [self.names[ix] for ix in names], src_ids, name_ids)
 
     def encode(self):
         """Encode the given sourcemap object into a mapping that contains all
@@ -308,48 +753,44 @@ class SourceMap:
         :return: a dictionary containing the encoded sourcemap fields
         :rtype: dict
         """
-        sources = {}
-        prev_src_id = next_src_id = 0
-        prev_src_line = prev_src_col = 0
-        names = {}
-        prev_name_id = next_name_id = 0
-        mappings = []
-        prev_dst_line = -1
-        for token in self.tokens:
-            while prev_dst_line < token.dst_line:
-                prev_dst_line += 1
-                prev_dst_col = 0
-                segments = []
-                mappings.append(segments)
-            vlq = [token.dst_col - prev_dst_col]
-            prev_dst_col = token.dst_col
-            if token.src:
-                source_id = sources.get(token.src)
-                if source_id is None:
-                    sources[token.src] = source_id = next_src_id
-                    next_src_id += 1
-                vlq.append(source_id - prev_src_id)
-                vlq.append(token.src_line - prev_src_line)
-                vlq.append(token.src_col - prev_src_col)
-                if token.name:
-                    name_id = names.get(token.name)
-                    if name_id is None:
-                        names[token.name] = name_id = next_name_id
-                        next_name_id += 1
-                    vlq.append(name_id - prev_name_id)
-                    prev_name_id = name_id
-                prev_src_id = source_id
-                prev_src_line = token.src_line
-                prev_src_col = token.src_col
-            segments.append(''.join(map(encode_vlq, vlq)))
-        data = {'version': 3,
-                'mappings': ';'.join(map(','.join, mappings)),
-                'sources': sorted(sources, key=lambda x: sources[x]),
-                'names': sorted(names, key=lambda x: names[x])}
-        data['sourcesContent'] = list(map(self.sources_content.get,
-                                          data['sources']))
+        sources, names, src_ids, name_ids = self._encoded_tables()
+        data = {'version': 3}
+        if self.file is not None:
+            data['file'] = self.file
+        data.update({'mappings': encode_mappings(self.dst_lines,
+                                                 self.dst_cols, src_ids,
+                                                 self.src_lines,
+                                                 self.src_cols, name_ids),
+                     'sources': sources,
+                     'names': names,
+                     'sourcesContent': list(map(self.sources_content.get,
+                                                sources))})
         return data
 
+    def dump(self, fobj):
+        """Write the JSON of the encoded map to the file-like `fobj`, the
+        same text returned by :meth:`stringify`, encoding the mappings a
+        line at a time."""
+        sources, names, src_ids, name_ids = self._encoded_tables()
+        fobj.write('{"version": 3, ')
+        if self.file is not None:
+            fobj.write('"file": ')
+            json.dump(self.file, fobj)
+            fobj.write(', ')
+        fobj.write('"mappings": "')
+        # the mappings contain only characters that need no escaping
+        for chunk in iter_encode_mappings(self.dst_lines, self.dst_cols,
+                                          src_ids, self.src_lines,
+                                          self.src_cols, name_ids):
+            fobj.write(chunk)
+        fobj.write('", "sources": ')
+        json.dump(sources, fobj)
+        fobj.write(', "names": ')
+        json.dump(names, fobj)
+        fobj.write(', "sourcesContent": ')
+        json.dump(list(map(self.sources_content.get, sources)), fobj)
+        fobj.write('}')
+
     def stringify(self, inline_comment=False):
         """Encode a SourceMap and return a string of its JSON dump, optionally
         encoding it with base64.
@@ -366,3 +807,60 @@ class SourceMap:
             data = ('\n//# sourceMappingURL=data:text/json;base64,%s\n' %
                     b64encode(data.encode('utf-8')).decode('ascii'))
         return data
+
+
+DECODED_MAPS_CACHE_SIZE = 32
+"""Number of source maps kept by :func:`load_source_map`."""
+
+_decoded_maps = OrderedDict()
+_decoded_maps_lock = threading.Lock()
+
+
+def load_source_map(path):
+    """Read and decode the source map stored in the file at `path`. The
+    last :data:`DECODED_MAPS_CACHE_SIZE` maps are kept in memory and reused
+    until their file changes, so they must not be modified.
+    """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _decoded_maps_lock:
+        cached = _decoded_maps.get(path)
+        if cached is not None and cached[0] == stamp:
+            _decoded_maps.move_to_end(path)
+            return cached[1]
+    with open(path, encoding='utf-8') as f:
+        smap = SourceMap.decode(f.read())
+    with _decoded_maps_lock:
+        _decoded_maps[path] = (stamp, smap)
+        _decoded_maps.move_to_end(path)
+        while len(_decoded_maps) > DECODED_MAPS_CACHE_SIZE:
+            _decoded_maps.popitem(last=False)
+    return smap
+
+
+def encode_index_map(sections, file=None):
+    """Build an *index map* out of `sections`, an iterable of ``(dst_line,
+    dst_col, smap)`` tuples where `smap` is the map of the part of the
+    generated code that starts at the given position. It can be either a
+    :class:`SourceMap` or an already encoded map, so that the maps of
+    the unchanged parts can be cached and reused.
+
+    :return: a dictionary that can be dumped as JSON
+    :rtype: dict
+    """
+    data = {'version': 3}
+    if file is not None:
+        data['file'] = file
+    data['sections'] = result = []
+    last = None
+    for dst_line, dst_col, smap in sections:
+        if last is not None and (dst_line, dst_col) <= last:
+            raise ValueError('The sections must be sorted by position and '
+                             'not overlap')
+        last = (dst_line, dst_col)
+        if isinstance(smap, SourceMap):
+            smap = smap.encode()
+        result.append({'offset': {'line': dst_line, 'column': dst_col},
+                       'map': smap})
+    return data
@@ -7,8 +7,9 @@
 #
 
 import ast
-import collections
 import contextlib
+import copy
+import inspect
 import os
 import sys
 import string
@@ -17,7 +18,8 @@ import textwrap
 from ..js_ast import TargetNode
 
 from .exceptions import TransformationError, UnsupportedSyntaxError
-from .util import (rfilter, parent_of, obj_source, body_local_names,
+from .scopes import ScopeAnalysis
+from .util import (rfilter, parent_of, obj_source, ScopedContext,
                    walk_under_code_boundary)
 
 SNIPPETS_TEMPLATE = """\
@@ -48,32 +50,39 @@ class Transformer:
     to the AST produced by a substransform."""
     remap_to = None
 
+    """The name of the module exporting the snippets, to import them from
+    it instead of inlining their code."""
+    runtime_module = None
+
     def __init__(self, py_ast_module, statements_class, snippets=True,
-                 es6=False, stage3=False, remap_to=None):
-        self.transformations = load_transformations(py_ast_module)
+                 es6=False, stage3=False, remap_to=None, runtime_module=None):
+        self.transformations = get_transformations(py_ast_module)
+        self.rules_index = get_rules_index(py_ast_module)
         self.statements_class = statements_class
         self.enable_snippets = snippets
         self.enable_es6 = es6
         self.enable_stage3 = stage3
         self.remap_to = remap_to
+        self.runtime_module = runtime_module
         self._init_structs()
 
     def _init_structs(self):
         self.snippets = set()
         self._globals = set()
-        self._args_stack = []
-        self._context = collections.ChainMap()
+        self._frames = []
+        self._context = ScopedContext()
         self._warnings = []
+        self._analysis = None
 
     @property
     def ctx(self):
         return self._context
 
     def _push_ctx(self, **kwargs):
-        self._context = self._context.new_child(kwargs)
+        self._context.push(**kwargs)
 
     def _pop_ctx(self):
-        self._context = self._context.parents
+        self._context.pop()
 
     @contextlib.contextmanager
     def context_for(self, py_node, **kwargs):
@@ -89,6 +98,7 @@ class Transformer:
         new = cls.__new__(cls)
         new._init_structs()
         new.transformations = instance.transformations
+        new.rules_index = instance.rules_index
         new.statements_class = instance.statements_class
         for k, v in vars(instance).items():
             if k.startswith('enable_'):
@@ -99,13 +109,17 @@ class Transformer:
         """Convert the given Python AST dump into JavaScript AST."""
         from ..js_ast import JSVarStatement
 
-        top = ast.parse(ast_tree)
+        if isinstance(ast_tree, ast.AST):
+            top = ast_tree
+        else:
+            top = ast.parse(ast_tree)
         body = top.body
-        self._args_stack.clear()
+        self._frames.clear()
 
-        self.node_parent_map = build_node_parent_map(top)
+        self._analysis = ScopeAnalysis(top)
+        self.node_parent_map = self._analysis.parents
 
-        local_vars = body_local_names(body)
+        local_vars = set(self.scope_of(top).local_names)
         self.ctx['vars'] = local_vars
         result = self.statements_class(*body)
         self._finalize_target_node(result)
@@ -119,6 +133,7 @@ class Transformer:
             result.transformed_args.insert(0, vars)
 
         self.node_parent_map = None
+        self._analysis = None
 
         return result
 
@@ -161,18 +176,56 @@ class Transformer:
     def has_child(self, node, cls):
         """Return true if `node` has any child that is an instance of
         `cls`."""
-        wanted = tuple(self.find_child(node, cls))
-        return len(wanted) > 0
+        if self._analysis is not None:
+            nodes = node if isinstance(node, (tuple, list, set)) else (node,)
+            found = self._analysis.contains(nodes, cls)
+            if found is not None:
+                return found
+        for c in self.find_child(node, cls):
+            return True
+        return False
+
+    def scope_of(self, node):
+        """Return the :class:`~.scopes.Scope` of the given code block node,
+        i.e. the top node or a function or class definition. Nodes built
+        during the transformation are analyzed on their own."""
+        scope = self._analysis.scopes.get(node)
+        if scope is None:
+            scope = ScopeAnalysis(node).scopes[node]
+        return scope
 
     def new_name(self):
-        """Generate a new name to use in statements."""
-        ix = self.ctx.setdefault('gen_name_ix', -1)
-        ix += 1
+        """Generate a new name to use in statements. The names are allocated
+        per statement, so that they are available again when the statement
+        that requested them is done, and those used by the code are
+        skipped.
+        """
+        ix = self.ctx.get('gen_name_ix', -1)
+        used = self._analysis.names if self._analysis is not None else ()
+        while True:
+            ix += 1
+            name = VAR_TEMPLATE % _name_suffix(ix)
+            if name not in used:
+                break
         self.ctx['gen_name_ix'] = ix
-        if ix > len(string.ascii_letters):
-            raise TransformationError("Reached maximum index for "
-                                      "auto-generated variable names")
-        return VAR_TEMPLATE % string.ascii_letters[ix]
+        return name
+
+    def restart_names(self):
+        """Generate the names from the beginning for the rest of the current
+        statement, which must be translated to a new JS function, where
+        they can shadow those of the enclosing code."""
+        self.ctx['gen_name_ix'] = -1
+
+    @contextlib.contextmanager
+    def new_names_scope(self):
+        """Generate the names requested inside the ``with`` block from the
+        beginning, for code that goes into a new JS function, like the one
+        of a comprehension."""
+        self._push_ctx(gen_name_ix=-1)
+        try:
+            yield
+        finally:
+            self._pop_ctx()
 
     def add_snippet(self, func):
         """Add a function to the snippets."""
@@ -180,49 +233,132 @@ class Transformer:
 
     def _transform_node(self, in_node):
         """Transform a Python AST node to a JS AST node."""
-
-        if isinstance(in_node, list) or isinstance(in_node, tuple):
-            res = [self._transform_node(child) for child in in_node]
-
-        elif isinstance(in_node, ast.AST):
-            # prepare a context for the transformation if it's a
-            # statement; it's used for example by try...catch stmts to
-            # give hints to raise
-            with self.context_for(in_node):
-                # transformations can come in tuples or lists, take the
-                # first one
-                for transformation in self.transformations.get(
-                        in_node.__class__.__name__, []):
-                    out_node = transformation(self, in_node)
-                    if out_node is not None:
-                        self._finalize_target_node(out_node, py_node=in_node)
-                        res = out_node
-                        break
-                else:
-                    raise TransformationError(
-                        in_node, "No transformation for the node")
-
-        elif isinstance(in_node, TargetNode):
-            self._finalize_target_node(in_node)
-            res = in_node
-        else:
-            # e.g. an integer
-            res = in_node
-        return res
+        res = []
+        self._transform_args((in_node,), res, False)
+        return res[0]
 
     def _finalize_target_node(self, tnode, py_node=None):
         tnode.py_node = self.remap_to or py_node or tnode.py_node
         tnode.transformer = self
         if tnode.transformed_args is None:
             tnode.transformed_args = targs = []
-            args = collections.deque(tnode.args)
-            self._args_stack.append(args)
-            while args:
-                arg = args.popleft()
-                targs.append(self._transform_node(arg))
-            self._args_stack.pop()
+            self._transform_args(tnode.args, targs, True)
+
+    def rules_for(self, py_node):
+        """Return the transformations that can be applied to `py_node`, in
+        the order they have to be tried. For the node classes in
+        ``MATCH_KEYS`` only those declaring the key of the node with
+        :func:`matches` and those not declaring any key are returned.
+        """
+        cls = py_node.__class__
+        entry = self.rules_index.get(cls)
+        if entry is None:
+            return self.transformations.get(cls, ())
+        key_func, by_key, generic = entry
+        return by_key.get(key_func(py_node), generic)
+
+    def _transform_args(self, args, targs, is_node):
+        """Transform the items of the `args` sequence, appending the results
+        to `targs`. The arguments of the produced JS nodes are transformed
+        in turn using an explicit stack instead of recursion, so the depth
+        of the tree is only bounded by the available memory.
+
+        Every frame of the stack is an ``(args, targs, is_node, pop_ctx)``
+        tuple, where `args` is an iterator over the items still to
+        transform, `is_node` tells if they are the arguments of a JS node,
+        instead of a list contained in them, and `pop_ctx` if the context
+        pushed for a statement has to be dropped when they are done. This
+        is the hot path of the transformation, so the lookups are done on
+        local names.
+        """
+        frames = self._frames
+        base = len(frames)
+        frames.append((iter(args), targs, is_node, False))
+        context = self._context
+        index = self.rules_index
+        table = self.transformations
+        remap_to = self.remap_to
+        AST = ast.AST
+        stmt = ast.stmt
+        while len(frames) > base:
+            args, targs, is_node, pop_ctx = frames[-1]
+            for arg in args:
+                if isinstance(arg, AST):
+                    # prepare a context for the transformation if it's a
+                    # statement; it's used for example by try...catch stmts
+                    # to give hints to raise
+                    is_stmt = isinstance(arg, stmt)
+                    if is_stmt:
+                        context.push()
+                    # see rules_for()
+                    cls = arg.__class__
+                    entry = index.get(cls)
+                    if entry is None:
+                        rules = table.get(cls, ())
+                    else:
+                        rules = entry[1].get(entry[0](arg), entry[2])
+                    # transformations can come in tuples or lists, take the
+                    # first one
+                    for transformation in rules:
+                        tnode = transformation(self, arg)
+                        if tnode is not None:
+                            break
+                    else:
+                        raise TransformationError(
+                            arg, "No transformation for the node")
+                    py_node = arg
+                elif isinstance(arg, TargetNode):
+                    tnode = arg
+                    py_node = None
+                    is_stmt = False
+                elif isinstance(arg, (list, tuple)):
+                    res = []
+                    targs.append(res)
+                    frames.append((iter(arg), res, False, False))
+                    break
+                else:
+                    # e.g. an integer
+                    targs.append(arg)
+                    continue
+                targs.append(tnode)
+                tnode.py_node = remap_to or py_node or tnode.py_node
+                tnode.transformer = self
+                if tnode.transformed_args is None:
+                    tnode.transformed_args = res = []
+                    frames.append((iter(tnode.args), res, True, is_stmt))
+                    break
+                elif is_stmt:
+                    context.pop()
+            else:
+                frames.pop()
+                if pop_ctx:
+                    context.pop()
 
     def transform_snippets(self):
+        """Return the JS AST of the snippets used by the code. It depends
+        only on which snippets are used and on the enabled features, so
+        it's built once and then shared, every caller getting its own
+        copy of the top level statements.
+
+        If a `runtime_module` is configured, the result is instead an
+        import of it as ``_pj``.
+        """
+        if self.runtime_module is not None:
+            from ..js_ast import JSStarImport
+            result = self.statements_class(
+                JSStarImport(self.runtime_module, '_pj'))
+            self._finalize_target_node(result)
+            return result
+        key = (frozenset(s.__name__ for s in self.snippets), self.enable_es6,
+               self.enable_stage3)
+        cached = _snippets_cache.get(key)
+        if cached is None:
+            cached = _snippets_cache[key] = self._transform_snippets()
+        result = copy.copy(cached)
+        result.transformed_args = list(cached.transformed_args)
+        return result
+
+    def _transform_snippets(self):
         snippets = tuple(sorted(self.snippets, key=lambda e: e.__name__))
         srcs = [obj_source(s) for s in snippets]
         src = textwrap.indent('\n'.join(srcs), ' ' * 4)
@@ -238,6 +374,22 @@ class Transformer:
         t.disable_srcmap = True
         return t.transform_code(trans_src)
 
+    def transform_runtime(self):
+        """Translate all the snippets to a module that exports them, to be
+        used as `runtime_module`."""
+        from .. import snippets
+        funcs = [f for name, f in sorted(vars(snippets).items())
+                 if inspect.isfunction(f) and
+                 f.__module__ == snippets.__name__]
+        src = '\n'.join(obj_source(f) for f in funcs)
+        src += '\n__all__ = [%s]\n' % ', '.join(repr(f.__name__)
+                                                for f in funcs)
+        t = self.new_from(self)
+        t.snippets = None
+        t.enable_snippets = False
+        t.disable_srcmap = True
+        return t.transform_code(src)
+
     def add_globals(self, *items):
         self._globals |= set(items)
 
@@ -250,7 +402,12 @@ class Transformer:
         self._guard(self.enable_es6, node, desc)
 
     def next_args(self):
-        return self._args_stack[-1]
+        """Return the iterator over the arguments of the JS node being
+        transformed that come after the current one. Consuming it skips
+        them."""
+        for args, targs, is_node, pop_ctx in reversed(self._frames):
+            if is_node:
+                return args
 
     def unsupported(self, py_node, cond, desc):
         """Raise an exception if `cond` is ``True``."""
@@ -284,41 +441,194 @@ class Transformer:
 
 #### Helpers
 
+def matches(*keys):
+    """Decorate a transformation to declare the keys of the nodes it applies
+    to, as computed by the functions in ``MATCH_KEYS``, so that it's tried
+    only on those. The transformation still has to check the node."""
+    def decorator(func):
+        func.match_keys = frozenset(keys)
+        return func
+    return decorator
+
+
+def _call_match_key(node):
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id
+    elif isinstance(func, ast.Attribute):
+        return func.attr
+
+
+MATCH_KEYS = {
+    ast.Attribute: lambda node: node.attr,
+    ast.BinOp: lambda node: node.op.__class__,
+    ast.Call: _call_match_key,
+    ast.Compare: lambda node: node.ops[0].__class__,
+    ast.Name: lambda node: node.id,
+    ast.Subscript: lambda node: node.slice.__class__,
+}
+"""The functions computing the key of a node, by node class: the name of
+the called function or method, the attribute name, the class of the
+operator or of the slice and the name."""
+
+
+def _name_suffix(ix):
+    """Return the suffix of the `ix`-th generated name: the ASCII letters,
+    then the pairs of them and so on."""
+    letters = string.ascii_letters
+    suffix = ''
+    ix += 1
+    while ix:
+        ix, rest = divmod(ix - 1, len(letters))
+        suffix = letters[rest] + suffix
+    return suffix
+
+
 def python_ast_names():
     #LATER: do this properly
     return rfilter(r'[A-Z][a-zA-Z]+', dir(ast))
 
 
 def load_transformations(py_ast_module):
+    """Build the dispatch table for the transformations contained in the
+    modules of the `py_ast_module` package. It is keyed by Python AST
+    node class and every value is a list of transformation functions to
+    be tried in order.
+    """
     # transformationsDict = {
-    #     'NodeName': [...transformation functions...]
+    #     ast.NodeClass: [...transformation functions...]
     # }
     d = {}
     ast_names = list(python_ast_names())
     filenames = rfilter(
         r'^[^.]+\.py$',
         os.listdir(parent_of(py_ast_module.__file__)))
-    for filename in filenames:
+    for filename in sorted(filenames):
         if filename != '__init__.py':
-            mod_name = 'metapensiero.pj.transformations.%s' % \
-                       filename.split('.')[0]
+            mod_name = '%s.%s' % (py_ast_module.__name__,
+                                  filename.split('.')[0])
             __import__(mod_name)
             mod = sys.modules[mod_name]
             for name in dir(mod):
                 if name in ast_names:
-                    assert name not in d
+                    node_type = getattr(ast, name)
+                    assert node_type not in d
                     value = getattr(mod, name)
-                    if not isinstance(value, list) or isinstance(value, tuple):
+                    if not isinstance(value, (list, tuple)):
                         value = [value]
-                    d[name] = value
+                    d[node_type] = list(value)
     return d
 
 
+_transformations_cache = {}
+
+_snippets_cache = {}
+
+
+def get_transformations(py_ast_module):
+    """Return the dispatch table for the `py_ast_module` package, building
+    it only the first time it is requested. The table is shared by all
+    the ``Transformer`` instances of the process, use
+    :func:`add_transformation` to extend it and
+    :func:`invalidate_transformations` to have it rebuilt.
+    """
+    d = _transformations_cache.get(py_ast_module.__name__)
+    if d is None:
+        d = load_transformations(py_ast_module)
+        _transformations_cache[py_ast_module.__name__] = d
+    return d
+
+
+def build_rules_index(transformations):
+    """Index the `transformations` table by the keys declared with
+    :func:`matches`. For every node class in ``MATCH_KEYS`` the value is a
+    ``(key_func, by_key, generic)`` tuple, where `by_key` maps every
+    declared key to the transformations to try for it and `generic` are
+    those to try for the other keys, i.e. those not declaring any.
+    """
+    index = {}
+    for cls, funcs in transformations.items():
+        key_func = MATCH_KEYS.get(cls)
+        if key_func is None:
+            continue
+        keys = set()
+        for f in funcs:
+            keys.update(getattr(f, 'match_keys', ()))
+        by_key = {k: [f for f in funcs
+                      if k in getattr(f, 'match_keys', (k,))]
+                  for k in keys}
+        generic = [f for f in funcs if not hasattr(f, 'match_keys')]
+        index[cls] = (key_func, by_key, generic)
+    return index
+
+
+_rules_index_cache = {}
+
+_generation = 0
+
+
+def transformations_generation():
+    """Return a counter that is incremented every time the dispatch tables
+    are changed by :func:`add_transformation` or discarded by
+    :func:`invalidate_transformations`, so that the results computed with
+    the previous rules can be recognized."""
+    return _generation
+
+
+def get_rules_index(py_ast_module):
+    """Return the index of the dispatch table for the `py_ast_module`
+    package, see :func:`build_rules_index`."""
+    index = _rules_index_cache.get(py_ast_module.__name__)
+    if index is None:
+        index = build_rules_index(get_transformations(py_ast_module))
+        _rules_index_cache[py_ast_module.__name__] = index
+    return index
+
+
+def invalidate_transformations(py_ast_module=None):
+    """Discard the cached dispatch table for `py_ast_module` or all of them
+    if it isn't specified, together with the translated snippets.
+    Transformers already created will keep using the table they got when
+    instantiated.
+    """
+    global _generation
+    _generation += 1
+    if py_ast_module is None:
+        _transformations_cache.clear()
+        _rules_index_cache.clear()
+    else:
+        _transformations_cache.pop(py_ast_module.__name__, None)
+        _rules_index_cache.pop(py_ast_module.__name__, None)
+    _snippets_cache.clear()
+
+
+def add_transformation(py_ast_module, node_type, func, last=False):
+    """Register `func` as a transformation for Python AST nodes of class
+    `node_type`. It will be tried before the other transformations for
+    the same class, unless `last` is true.
+    """
+    global _generation
+    _generation += 1
+    table = get_transformations(py_ast_module)
+    funcs = table.setdefault(node_type, [])
+    if last:
+        funcs.append(func)
+    else:
+        funcs.insert(0, func)
+    # update the index in place, the transformers share it
+    index = get_rules_index(py_ast_module)
+    index.clear()
+    index.update(build_rules_index(table))
+    # the snippets are translated with the same rules
+    _snippets_cache.clear()
+
+
 def build_node_parent_map(top):
 
     node_parent_map = {}
-
-    def _process_node(node):
+    stack = [top]
+    while stack:
+        node = stack.pop()
         for k in node._fields:
             x = getattr(node, k)
             if not (isinstance(x, list) or isinstance(x, tuple)):
@@ -326,8 +636,6 @@ def build_node_parent_map(top):
             for y in x:
                 if isinstance(y, ast.AST):
                     node_parent_map[y] = node
-                    _process_node(y)
-
-    _process_node(top)
+                    stack.append(y)
 
     return node_parent_map
@@ -7,6 +7,7 @@
 #
 
 import ast
+import collections.abc
 import inspect
 import re
 import textwrap
@@ -181,30 +182,85 @@ def rfilter(r, it, invert=False):
                 yield x
 
 
+_MISSING = object()
+
+
+class ScopedContext(collections.abc.MutableMapping):
+    """A mapping whose changes are scoped: those made after :meth:`push` are
+    undone by the matching :meth:`pop`. It behaves like a ``ChainMap``
+    getting a new child at every push, but the values are kept in a single
+    dict, so the lookups don't depend on the nesting, and a push costs
+    just the recording of the position in the undo trail.
+    """
+
+    __slots__ = ('_values', '_trail', '_marks')
+
+    def __init__(self, **kwargs):
+        self._values = dict(kwargs)
+        self._trail = []
+        self._marks = []
+
+    def push(self, **kwargs):
+        """Start a new scope, setting the given values in it."""
+        self._marks.append(len(self._trail))
+        for k, v in kwargs.items():
+            self[k] = v
+
+    def pop(self):
+        """Undo the changes made since the matching :meth:`push`."""
+        mark = self._marks.pop()
+        values = self._values
+        trail = self._trail
+        while len(trail) > mark:
+            key, old = trail.pop()
+            if old is _MISSING:
+                del values[key]
+            else:
+                values[key] = old
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if self._marks:
+            self._trail.append((key, self._values.get(key, _MISSING)))
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        if self._marks:
+            self._trail.append((key, self._values[key]))
+        del self._values[key]
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+
 class OutputSrc:
 
     def __init__(self, node, name=None):
         self.node = node
         self.src_name = name
 
-    def _gen_mapping(self, text, src_line=None, src_offset=None,
-                     dst_offset=None):
-        """Generate a single mapping. `dst_line` is absent from signature
-        because the part hasn't this information, but is present in the
-        returned mapping. `src_line` is adjusted to be 0-based.
+    def _gen_mapping(self, dst_offset, src_line, src_offset, name=None):
+        """Generate a single mapping as a compact ``(dst_offset, src_line,
+        src_offset, name)`` tuple. `dst_line` is absent because the part
+        hasn't this information, it's added by the :class:`Block`.
+        `src_line` is 1-based like in the Python AST.
 
         See `Source Map version 3 proposal
         <https://docs.google.com/document/d/1U1RGAehQwRypUTovF1KRlpiOFze0b-_2gc6fAH0KY0k>`_.
         """
-        return {
-            'src_line': src_line,
-            'src_offset': src_offset,
-            'dst_line': None,
-            'dst_offset': dst_offset,
-            'text': text,
-            'name': self.src_name if self.src_name is not True else str(self),
-            'part': self
-        }
+        return (dst_offset, src_line, src_offset,
+                self.src_name if name is None else name)
 
     def _pos_in_src(self):
         """Return the position in source of the generated node."""
@@ -229,6 +285,17 @@ class OutputSrc:
         return result
 
 
+def _mapping_dict(mapping, dst_line=None):
+    dst_offset, src_line, src_offset, name = mapping
+    return {
+        'src_line': src_line,
+        'src_offset': src_offset,
+        'dst_line': dst_line,
+        'dst_offset': dst_offset,
+        'name': name
+    }
+
+
 class Line(OutputSrc):
 
     def __init__(self, node, item, indent=False, delim=False, name=None):
@@ -240,31 +307,44 @@ class Line(OutputSrc):
         self.item = item
 
     def __str__(self):
-        line = str(self.item)
+        out = []
+        self.emit(out)
+        return ''.join(out)
+
+    def emit(self, out, mappings=None):
+        """Append the text of this line to the `out` list and, if `mappings`
+        is a list, the source mappings of its content to it. Column offsets
+        are computed while emitting, so the whole operation is linear in the
+        size of the text."""
+        if mappings is not None and self.node.transformer.disable_srcmap:
+            mappings = None
+        offset = self.indent * 4
+        buf = []
+        if isinstance(self.item, Part):
+            self.item.emit(buf, offset, mappings)
+        else:
+            text = str(self.item)
+            buf.append(text)
+            if mappings is not None:
+                src_line, src_offset = self._pos_in_src()
+                if src_line:
+                    mappings.append(self._gen_mapping(
+                        offset, src_line, src_offset,
+                        text if self.src_name is True else None))
         if self.delim:
-            line += ';'
+            buf.append(';')
+        line = ''.join(buf)
         if self.indent and line.strip():
-            line = (' ' * 4 * self.indent) + line
-        line += '\n'
-        return line
+            line = (' ' * offset) + line
+        out.append(line + '\n')
 
     def serialize(self):
         yield self
 
     def src_mappings(self):
-        if self.node.transformer.disable_srcmap:
-            return
-        src_line, src_offset = self._pos_in_src()
-        offset = self.indent * 4
-        if isinstance(self.item, str):
-            if src_line:
-                yield self._gen_mapping(self.item, src_line, src_offset,
-                                        offset)
-        else:
-            assert isinstance(self.item, Part)
-            for m in self.item.src_mappings():
-                m['dst_offset'] += offset
-                yield m
+        mappings = []
+        self.emit([], mappings)
+        return map(_mapping_dict, mappings)
 
     def __repr__(self):
         return '<%s indent: %d, "%s">' % (self.__class__.__name__,
@@ -285,106 +365,214 @@ class Part(OutputSrc):
                 self.items.append(str(i))
 
     def __str__(self):
-        return ''.join(str(i) for i in self.items)
+        out = []
+        self.emit(out)
+        return ''.join(out)
 
     def serialize(self):
         yield self
 
-    def src_mappings(self):
-        if self.node.transformer.disable_srcmap:
-            return
-        # optional position in source file, if this is missing, there's no
-        # reason for generate a source mapping. (not all python AST elements
-        # can be source located)
-        src_line, src_offset = self._pos_in_src()
-        # accumulator for string text
-        frag = ''
-        col = 0
-        # for every item that composes this part...
-        for i in self.items:
-            assert isinstance(i, (str, Part))
-            if isinstance(i, str):
-                # if it's a string, just add it to the accumulator (usually
-                # comma, parens, etc...)
-                frag += i
-            elif isinstance(i, Part):
-                # if the item is a part
+    def emit(self, out, col=0, mappings=None):
+        """Append the text of this part to the `out` list, starting at column
+        `col`, and, if `mappings` is a list, the source mappings of it and of
+        its sub-parts. Return the column where the text ends.
+
+        The sub-parts are visited using an explicit stack, so that deeply
+        nested parts don't hit the recursion limit.
+        """
+        stack = []
+        part = self
+        while True:
+            if mappings is not None and part.node.transformer.disable_srcmap:
+                mappings = None
+            # optional position in source file, if this is missing, there's
+            # no reason for generate a source mapping. (not all python AST
+            # elements can be source located)
+            if mappings is not None:
+                src_line, src_offset = part._pos_in_src()
+            else:
+                src_line = src_offset = None
+            if src_line and part.src_name is True:
+                # the name is the whole text of the part, the mappings need
+                # to be updated once it's complete
+                out_start = len(out)
+                own = []
+            else:
+                out_start = own = None
+            items = iter(part.items)
+            # accumulator for string text and its starting column
+            frag = False
+            frag_col = col
+            while True:
+                sub = None
+                # for every item that composes this part...
+                for i in items:
+                    if isinstance(i, str):
+                        # if it's a string, just add it to the accumulator
+                        # (usually comma, parens, etc...)
+                        out.append(i)
+                        col += len(i)
+                        frag = frag or bool(i)
+                        continue
+                    # if the item is a part and there is accumulated text and
+                    # a src location emit a src mapping for the accumulated
+                    # text and reset it
+                    if frag and src_line:
+                        if own is not None:
+                            own.append(len(mappings))
+                        mappings.append(part._gen_mapping(frag_col, src_line,
+                                                          src_offset))
+                    if isinstance(i, Part):
+                        # ... then, let the subpart emit its text and its
+                        # mappings, resuming this one afterwards
+                        sub = i
+                        break
+                    col = i.emit(out, col, mappings)
+                    frag = False
+                    frag_col = col
+                if sub is not None:
+                    stack.append((part, items, mappings, src_line, src_offset,
+                                  out_start, own))
+                    part = sub
+                    break
+                # at the end of the loop, if there is still a fragment and a
+                # src location, emit a mapping for it
                 if frag and src_line:
-                    # .. and if there is accumulated text and a src location
-                    # emit a src mapping for the accumulated text and reset it
-                    yield self._gen_mapping(frag, src_line, src_offset, col)
-                col += len(frag)
-                frag = ''
-                psrc = str(i)
-                # ... then , ask the subpart to produce a src mapping and
-                # maybe relocate it if necessary
-                # yield from i._translate_src_mappings(i, src, psrc, col)
-                for m in i.src_mappings():
-                    m['dst_offset'] += col
-                    yield m
-                col += len(psrc)
-        else:
-            # at the end of the loop, if there is still a fragment and a src
-            # location, emit a mapping for it
-            if frag and src_line:
-                yield self._gen_mapping(frag, src_line, src_offset, col)
-
-    def _translate_src_mappings(self, part, src=None, psrc=None, start=None):
-        src = src or str(self)
-        psrc = psrc or str(part)
-        offset = src.find(psrc, start)
-        for m in part.src_mappings():
-            m['dst_offset'] += offset
-            yield m
+                    if own is not None:
+                        own.append(len(mappings))
+                    mappings.append(part._gen_mapping(frag_col, src_line,
+                                                      src_offset))
+                if own:
+                    name = ''.join(out[out_start:])
+                    for ix in own:
+                        mappings[ix] = mappings[ix][:3] + (name,)
+                if not stack:
+                    return col
+                (part, items, mappings, src_line, src_offset, out_start,
+                 own) = stack.pop()
+                frag = False
+                frag_col = col
+
+    def src_mappings(self):
+        mappings = []
+        self.emit([], 0, mappings)
+        return map(_mapping_dict, mappings)
 
     def __repr__(self):
         return '<%s, "%s">' % (self.__class__.__name__,
                                str(self))
 
 
-def linecounter(iterable, start=1):
-    count = start
-    for line in iterable:
-        yield count, line
-        count += len(re.findall('\n', str(line)))
-
-
 class Block(OutputSrc):
 
     def __init__(self, node):
         super().__init__(None)
-        self.lines = list(node.serialize())
+        self._node = node
+        self._lines = None
+
+    @property
+    def lines(self):
+        """The serialized lines of the node, kept once computed."""
+        if self._lines is None:
+            self._lines = list(self._node.serialize())
+        return self._lines
+
+    def _iter_lines(self):
+        if self._lines is None:
+            return self._node.serialize()
+        return self._lines
+
+    def _emit_line(self, line, out, mappings=None):
+        if isinstance(line, Line):
+            line.emit(out, mappings)
+        else:
+            line.emit(out, 0, mappings)
 
-    def src_mappings(self, src_offset=None, dst_offset=None):
+    def render(self, source=None, src_filename=None, src_offset=None,
+               dst_offset=None, sourcemap=True):
+        """Produce the text of the block and its source map together, in a
+        single traversal of the lines. Return a ``(text, src_map)`` tuple,
+        where `src_map` is ``None`` if `sourcemap` is false.
+        """
+        out = []
+        src_map = self._render(out, None, source, src_filename, src_offset,
+                               dst_offset, sourcemap)
+        return ''.join(out), src_map
+
+    def write(self, fobj, source=None, src_filename=None, src_offset=None,
+              dst_offset=None, sourcemap=True):
+        """Like :meth:`render`, but write the text to the file-like `fobj`
+        while the lines are serialized, without keeping all of it in
+        memory. Return the source map or ``None``.
+        """
+        out = []
+
+        def flush():
+            fobj.write(''.join(out))
+            out.clear()
+
+        src_map = self._render(out, flush, source, src_filename, src_offset,
+                               dst_offset, sourcemap)
+        flush()
+        return src_map
+
+    def _render(self, out, flush, source, src_filename, src_offset,
+                dst_offset, sourcemap):
+        if not sourcemap:
+            for line in self._iter_lines():
+                self._emit_line(line, out)
+                if flush is not None and len(out) > 1024:
+                    flush()
+            return None
 
+        sline_offset, scol_offset = src_offset or (0, 0)
+        # source lines in the mappings are 1-based
+        sline_offset -= 1
+        dst_line, dcol_offset = dst_offset or (0, 0)
+        src_map = sourcemaps.SourceMap(
+            sources_content={src_filename: source}
+        )
+        add_segment = src_map.add_segment
+        name_id = src_map.name_id
+        src_id = src_map.source_id(src_filename)
+        mappings = []
+        for line in self._iter_lines():
+            start = len(out)
+            self._emit_line(line, out, mappings)
+            if mappings:
+                for dst_col, src_line, src_col, name in mappings:
+                    add_segment(dst_line, dst_col + dcol_offset, src_id,
+                                src_line + sline_offset,
+                                src_col + scol_offset, name_id(name))
+                mappings.clear()
+            for ix in range(start, len(out)):
+                dst_line += out[ix].count('\n')
+            if flush is not None and len(out) > 1024:
+                flush()
+        return src_map
+
+    def src_mappings(self, src_offset=None, dst_offset=None):
         sline_offset, scol_offset = src_offset or (0, 0)
         dline_offset, dcol_offset = dst_offset or (0, 0)
-        for ix, line in linecounter(self.lines, start=1):
-            for m in line.src_mappings():
-                m['dst_line'] = ix + dline_offset
+        dst_line = 1
+        for line in self.lines:
+            out = []
+            mappings = []
+            self._emit_line(line, out, mappings)
+            for m in mappings:
+                m = _mapping_dict(m, dst_line + dline_offset)
                 m['dst_offset'] += dcol_offset
                 m['src_line'] += sline_offset
                 m['src_offset'] += scol_offset
                 yield m
+            dst_line += sum(t.count('\n') for t in out)
 
     def read(self):
-        return ''.join(str(l) for l in self.lines)
+        return self.render(sourcemap=False)[0]
 
     def sourcemap(self, source, src_filename, src_offset=None,
                   dst_offset=None):
-        Token = sourcemaps.Token
-        tokens = []
-        for m in self.src_mappings(src_offset, dst_offset):
-            token = Token(m['dst_line'] - 1, m['dst_offset'], src_filename,
-                          m['src_line'] - 1, m['src_offset'], m['name'], m)
-            tokens.append(token)
-
-        src_map = sourcemaps.SourceMap(
-            sources_content={src_filename: source}
-        )
-        for t in tokens:
-            src_map.add_token(t)
-        return src_map
+        return self.render(source, src_filename, src_offset, dst_offset)[1]
 
 
 def obj_source(obj):
@@ -9,7 +9,8 @@
 import ast
 
 from ..compat import assign_types, is_py39
-from ..processor.util import controlled_ast_walk, get_assign_targets
+from ..processor.transforming import matches
+from ..processor.util import get_assign_targets
 from ..js_ast import (
     JSAssignmentExpression,
     JSAttribute,
@@ -160,15 +161,6 @@ def ClassDef_default(t, x):
         t.unsupported(node, len(arg_names) == 0 or arg_names[0] != 'self',
                       "First arg on method must be 'self'")
 
-    # TODO: better express this... find if the constructor has to be the first
-    # as per ES6 doc
-    if len(fn_body) > 0 and fn_body[0].name == '__init__':
-        init = body[0]
-        # __init__ should not contain a return statement
-        # silly check
-        for stmt in controlled_ast_walk(init):
-            assert not isinstance(stmt, ast.Return)
-
     # manage decorators. some are managed at class translation time and
     # converted to equal ES6 syntax while the generic ones will be calculated
     # at runtime
@@ -376,6 +368,7 @@ def Subscript_super(t, x):
             return result
 
 
+@matches('isinstance')
 def Call_isinstance(t, x):
     """Translate ``isinstance(foo, Bar)`` to ``foo instanceof Bar`` and
     ``isinstance(Foo, (Bar, Zoo))`` to ``foo instanceof Bar || foo instanceof
@@ -400,6 +393,7 @@ def Call_isinstance(t, x):
         return _build_call_isinstance(x.args[0], x.args[1])
 
 
+@matches('issubclass')
 def Call_issubclass(t, x):
     """Translate ``issubclass(Foo, Bar)`` to
     ``Bar.prototype.isPrototypeOf(Foo.prototype)``.
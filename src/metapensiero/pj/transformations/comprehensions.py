@@ -48,10 +48,12 @@ def ListComp(t, x):
     else:
         CONDITION = None
 
-    __new = t.new_name()
-    __old = t.new_name()
-    __i = t.new_name()
-    __bound = t.new_name()
+    # the names are local to the function built below
+    with t.new_names_scope():
+        __new = t.new_name()
+        __old = t.new_name()
+        __i = t.new_name()
+        __bound = t.new_name()
 
     # Let's construct the result from the inside out:
     #<pre>__new.push(EXPR);</pre>
@@ -7,7 +7,6 @@
 #
 
 import ast
-from functools import reduce
 
 
 from ..js_ast import (
@@ -32,28 +31,17 @@ from ..js_ast import (
     JSThis,
     JSVarStatement,
 )
-from ..processor.util import body_local_names, walk_under_code_boundary
-
 from . import _normalize_name
 
 
-def _isyield(el):
-    return isinstance(el, (ast.Yield, ast.YieldFrom))
-
-
 def FunctionDef(t, x, fwrapper=None, mwrapper=None):
 
+    scope = t.scope_of(x)
     is_method = isinstance(t.parent_of(x), ast.ClassDef)
-    is_in_method = not x.name.startswith('fn_') and \
-                   all(lambda p: isinstance(p, (ast.FunctionDef,
-                                                ast.AsyncFunctionDef,
-                                                ast.ClassDef)) \
-                       for p in t.parents(x, stop_at=ast.ClassDef)) and \
-                           isinstance(tuple(t.parents(x, stop_at=ast.ClassDef))[-1],
-                                      ast.ClassDef) # Make sure a class is there
-
-    is_generator = reduce(lambda prev, cur: _isyield(cur) or prev,
-                          walk_under_code_boundary(x.body), False)
+    # Make sure a class is there
+    is_in_method = (not x.name.startswith('fn_') and
+                    scope.enclosing_class is not None)
+    is_generator = scope.is_generator
 
     t.unsupported(x, not is_method and x.decorator_list, "Function decorators are"
                   " unsupported yet")
@@ -121,9 +109,11 @@ def FunctionDef(t, x, fwrapper=None, mwrapper=None):
         upper_vars = t.ctx['vars']
     else:
         upper_vars = set()
-    local_vars = list((set(body_local_names(body)) - set(arg_names)) -
+    local_vars = list((scope.local_names - set(arg_names)) -
                       set(kw_names) - upper_vars)
     t.ctx['vars'] = upper_vars | set(local_vars)
+    # the body is a new JS function, the loops in it can reuse the names
+    t.restart_names()
     if len(local_vars) > 0:
         local_vars.sort()
         body = JSStatements(
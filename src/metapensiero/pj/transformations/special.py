@@ -64,6 +64,7 @@ from .obvious import (
     Subscript_default,
 )
 
+from ..processor.transforming import matches
 from . import _normalize_name
 
 
@@ -79,6 +80,7 @@ Expr = [Expr_docstring, Expr_default]
 
 
 # <code>2**3</code> &rarr; <code>Math.pow(2, 3)</code>
+@matches(ast.Pow)
 def BinOp_pow(t, x):
     if isinstance(x.op, ast.Pow):
         return JSCall(
@@ -92,6 +94,7 @@ BinOp = [BinOp_pow, BinOp_default]
 
 
 # <code>self</code> &rarr; <code>this</code>
+@matches('self')
 def Name_self(t, x):
     if x.id == 'self':
         return JSThis()
@@ -101,12 +104,14 @@ Name = [Name_self, Name_default]
 
 
 # <code>typeof(x)</code> &rarr; <code>(typeof x)</code>
+@matches('typeof')
 def Call_typeof(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'typeof'):
         assert len(x.args) == 1
         return JSUnaryOp(JSOpTypeof(), x.args[0])
 
 
+@matches('callable')
 def Call_callable(t, x):
     """Translate ``callable(foo)`` to ``foo instanceof Function``."""
     if (isinstance(x.func, ast.Name) and x.func.id == 'callable'):
@@ -123,18 +128,21 @@ def Call_callable(t, x):
 
 
 # <code>print(...)</code> &rarr; <code>console.log(...)</code>
+@matches('print')
 def Call_print(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'print'):
         return JSCall(JSAttribute(JSName('console'), 'log'), x.args)
 
 
 # <code>len(x)</code> &rarr; <code>x.length</code>
+@matches('len')
 def Call_len(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'len' and
         len(x.args) == 1):
         return JSAttribute(x.args[0], 'length')
 
 
+@matches('str')
 def Call_str(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'str' and
         len(x.args) == 1):
@@ -165,6 +173,7 @@ def Call_new(t, x):
         return Call_default(t, subj, operator='new ')
 
 
+@matches('__import__')
 def Call_import(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == '__import__'):
         assert len(x.args) == 1 and isinstance(x.args[0], ast.Str)
@@ -172,12 +181,14 @@ def Call_import(t, x):
         return JSDependImport(x.args[0].s)
 
 
+@matches('type')
 def Call_type(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'type'):
         assert len(x.args) == 1
         return JSCall(JSAttribute(JSName('Object'), 'getPrototypeOf'), x.args)
 
 
+@matches('update')
 def Call_dict_update(t, x):
     """Convert ``dict(foo).update(bar)`` to ``Object.assign(foo, bar)``.
 
@@ -208,6 +219,7 @@ def Call_dict_update(t, x):
             )
 
 
+@matches('copy')
 def Call_dict_copy(t, x):
     """Convert ``dict(foo).copy()`` to ``Object.assign({}, foo)``.
 
@@ -236,6 +248,7 @@ def Call_dict_copy(t, x):
             )
 
 
+@matches('tmpl')
 def Call_template(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'tmpl') and \
        len(x.args) > 0:
@@ -245,6 +258,7 @@ def Call_template(t, x):
         return JSTemplateLiteral(x.args[0].s)
 
 
+@matches('__')
 def Call_tagged_template(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == '__') and \
        len(x.args) > 0 and t.parent_of(x) is not ast.Attribute:
@@ -258,6 +272,7 @@ def Call_tagged_template(t, x):
         return JSTaggedTemplate(x.args[0].s, tag)
 
 
+@matches('hasattr')
 def Call_hasattr(t, x):
     """Translate ``hasattr(foo, bar)`` to ``bar in foo``."""
     if (isinstance(x.func, ast.Name) and x.func.id == 'hasattr') and \
@@ -265,6 +280,7 @@ def Call_hasattr(t, x):
         return JSBinOp(x.args[1], JSOpIn(), x.args[0])
 
 
+@matches('getattr')
 def Call_getattr(t, x):
     """Translate ``getattr(foo, bar, default)`` to ``foo[bar] || default``."""
     if (isinstance(x.func, ast.Name) and x.func.id == 'getattr') and \
@@ -280,6 +296,7 @@ def Call_getattr(t, x):
         return res
 
 
+@matches('setattr')
 def Call_setattr(t, x):
     """Translate ``setattr(foo, bar, value)`` to ``foo[bar] = value``."""
     if (isinstance(x.func, ast.Name) and x.func.id == 'setattr') and \
@@ -292,6 +309,7 @@ def Call_setattr(t, x):
         )
 
 
+@matches('JS')
 def Call_JS(t, x):
     if (isinstance(x.func, ast.Name) and x.func.id == 'JS') and \
        len(x.args) == 1:
@@ -299,6 +317,7 @@ def Call_JS(t, x):
         return JSLiteral(x.args[0].s)
 
 
+@matches('int')
 def Call_int(t, x):
     # maybe this needs a special keywords mangling for optional "base" param
     if isinstance(x.func, ast.Name) and x.func.id == 'int':
@@ -308,6 +327,7 @@ def Call_int(t, x):
             return JSCall(JSName('parseInt'), x.args)
 
 
+@matches('float')
 def Call_float(t, x):
     if isinstance(x.func, ast.Name) and x.func.id == 'float':
         if t.enable_es6:
@@ -483,6 +503,7 @@ def ImportFrom(t, x):
     return result
 
 
+@matches(ast.In, ast.NotIn)
 def Compare_in(t, x):
     if not isinstance(x.ops[0], (ast.NotIn, ast.In)):
         return
@@ -503,6 +524,7 @@ def Compare_in(t, x):
 Compare = [Compare_in, Compare_default]
 
 
+@matches(ast.Slice)
 def Subscript_slice(t, x):
 
     if isinstance(x.slice, ast.Slice):
@@ -523,6 +545,7 @@ def Subscript_slice(t, x):
 Subscript = [Subscript_slice, Subscript_super, Subscript_default]
 
 
+@matches('append')
 def Attribute_list_append(t, x):
     """Convert ``list(foo).append(bar)`` to ``foo.push(bar)``.
 
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- translation benchmark
+# :Created:  dom 18 ott 2026 10:24:32 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+"""Measure the time needed to translate the sources used by the tests,
+that is the transformation of their Python AST into the JS AST and the
+complete ``translates()``, reporting the best of the repetitions.
+
+Run it with ``python tests/benchmark.py [-r REPEAT] [-n NUMBER]``.
+"""
+
+import argparse
+import ast
+from glob import glob
+from os.path import dirname, join
+import time
+import warnings
+
+from metapensiero.pj import transformations
+from metapensiero.pj.api import translates
+from metapensiero.pj.js_ast import JSStatements
+from metapensiero.pj.processor.transforming import Transformer
+
+from conftest import load_python_code
+
+
+def load_corpus():
+    """Return a list of ``(src_text, es6)`` tuples of the test sources that
+    can be translated."""
+    corpus = []
+    pattern = join(dirname(__file__), 'test_*', '**', '*.py')
+    for fname in sorted(glob(pattern, recursive=True)):
+        py_code, py_src, options = load_python_code(fname)
+        if py_code is None:
+            continue
+        es6 = options.get('enable_es6', False)
+        try:
+            translates(py_src, enable_es6=es6)
+        except Exception:
+            continue
+        corpus.append((py_src, es6))
+    return corpus
+
+
+def best_of(func, repeat, number):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-n', '--number', type=int, default=5)
+    args = parser.parse_args()
+    warnings.simplefilter('ignore')
+    corpus = load_corpus()
+    trees = [(ast.parse(src), es6) for src, es6 in corpus]
+
+    def transform():
+        for tree, es6 in trees:
+            t = Transformer(transformations, JSStatements, snippets=False,
+                            es6=es6)
+            t.transform_code(tree)
+
+    def translate():
+        for src, es6 in corpus:
+            translates(src, enable_es6=es6)
+
+    print('%d sources, %d lines' % (len(corpus),
+                                    sum(s.count('\n') for s, e in corpus)))
+    for name, func in (('transform', transform), ('translates', translate)):
+        print('%-10s %8.2f ms' % (name, best_of(func, args.repeat,
+                                                args.number) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- caches tests
+# :Created:  dom 18 ott 2026 09:56:31 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+import os
+
+import pytest
+
+from metapensiero.pj import api
+from metapensiero.pj.cache import DiskCache, MemoryCache, cache_key
+
+
+def test_memory_cache():
+    cache = MemoryCache(2)
+    assert cache.get('a') is None
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'entries': 2}
+
+
+def test_disk_cache_eviction(tmp_path):
+    cache = DiskCache(tmp_path, max_size=3000)
+    keys = [cache_key('entry', i) for i in range(5)]
+    for i, key in enumerate(keys):
+        cache.set(key, 'x' * 1000)
+        # make the use order deterministic
+        os.utime(cache._path(key), ns=(i * 10**9, i * 10**9))
+    assert len(cache) <= 3
+    assert cache.get(keys[-1]) == 'x' * 1000
+    assert cache.get(keys[0]) is None
+    assert DiskCache(tmp_path).get(keys[-1]) == 'x' * 1000
+
+
+def test_disk_cache_overwrite_size(tmp_path):
+    cache = DiskCache(tmp_path, max_size=10000)
+    keys = [cache_key('entry', i) for i in range(2)]
+    for key in keys:
+        cache.set(key, 'x' * 1000)
+    # replacing the same entries doesn't grow the total size
+    for _ in range(5):
+        for key in keys:
+            cache.set(key, 'y' * 1000)
+    assert cache._size == sum(cache._path(k).stat().st_size for k in keys)
+    assert len(cache) == 2
+
+
+def test_disk_cache_stores_json(tmp_path):
+    import json
+    from metapensiero.pj.cache import Cache
+
+    with pytest.raises(TypeError):
+        Cache()
+    cache = DiskCache(tmp_path)
+    key = cache_key('entry')
+    cache.set(key, {'code': 'var a;', 'map': None})
+    with open(cache._path(key), encoding='utf-8') as f:
+        assert json.load(f) == {'code': 'var a;', 'map': None}
+    assert cache.get(key) == {'code': 'var a;', 'map': None}
+    cache._path(key).write_bytes(b'\x80garbage')
+    assert cache.get(key) is None
+
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_translation_cache(tmp_path, disk):
+    src = 'def foo(a):\n    return a in [1, 2]\n'
+    expected = api.translates(src, src_filename='foo.py')
+    cache = api.configure_translation_cache(
+        directory=str(tmp_path) if disk else None)
+    try:
+        first = api.translates(src, src_filename='foo.py')
+        second = api.translates(src, src_filename='foo.py')
+        api.translates(src, src_filename='foo.py', enable_es6=True)
+        assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 2}
+        for js_text, src_map in (first, second):
+            assert js_text == expected[0]
+            assert src_map.tokens == expected[1].tokens
+    finally:
+        api.configure_translation_cache(0)
+    assert api.get_translation_cache() is None
+
+
+@pytest.mark.parametrize('disk', [False, True])
+def test_translation_cache_follows_rules(tmp_path, disk):
+    import ast
+    from metapensiero.pj import transformations
+    from metapensiero.pj.js_ast import JSCommentBlock
+    from metapensiero.pj.processor.transforming import (
+        add_transformation, invalidate_transformations)
+
+    def Pass_custom(t, x):
+        return JSCommentBlock('custom pass')
+
+    api.configure_translation_cache(directory=str(tmp_path) if disk else None)
+    try:
+        assert 'custom pass' not in api.translates('pass')[0]
+        add_transformation(transformations, ast.Pass, Pass_custom)
+        assert 'custom pass' in api.translates('pass')[0]
+        invalidate_transformations(transformations)
+        assert 'custom pass' not in api.translates('pass')[0]
+    finally:
+        invalidate_transformations(transformations)
+        api.configure_translation_cache(0)
+
+
+def test_babel_cache(tmp_path):
+    cache = api.configure_babel_cache(str(tmp_path))
+    try:
+        first = api.transpile_es6s('let a = () => 1;')
+        assert cache.stats() == {'hits': 0, 'misses': 1, 'entries': 1}
+        assert api.transpile_es6s('let a = () => 1;') == first
+        api.transpile_es6s('let a = () => 1;', enable_stage3=True)
+        assert cache.stats() == {'hits': 1, 'misses': 2, 'entries': 2}
+    finally:
+        api.configure_babel_cache(max_size=0)
+    assert api.get_babel_cache() is None
@@ -5,8 +5,11 @@
 # :License:  GNU General Public License version 3 or later
 #
 
+import os
+
 import pytest
 
+from metapensiero.pj import api
 from metapensiero.pj.api import eval_object, eval_object_es6, translate_object
 
 
@@ -796,6 +799,100 @@ def test_float_conversion():
     assert eval_object(test_float, 'test_float();') == test_float()
 
 
+def test_babel_pool_checkout():
+    from metapensiero.pj.api import BabelPool
+
+    pool = BabelPool(2)
+    with pool.checkout() as first:
+        with pool.checkout() as second:
+            assert first is not second
+            assert pool._created == 2
+            assert len(pool.load_times) == 2
+    with pool.checkout() as again:
+        assert again in (first, second)
+    res = pool.compile('let a = 1;', presets=['es2015'])
+    assert res['code'] == '"use strict";\n\nvar a = 1;'
+    pool.close()
+
+
+def test_babel_pool_processes(tmp_path, monkeypatch):
+    from metapensiero.pj import api
+
+    # the default pool and cache are restored at the end
+    monkeypatch.setattr(api, 'BABEL_POOL', None)
+    monkeypatch.setattr(api, 'BABEL_CACHE', None)
+    pool = api.configure_babel_pool(2, processes=True)
+    assert api.get_babel_pool() is pool
+    cache = api.configure_babel_cache(str(tmp_path))
+    try:
+        first = api.transpile_es6s('let a = () => 1;')
+        assert 'var a = function a()' in first[0]
+        assert api.transpile_es6s('let a = () => 1;') == first
+        res = pool.compile('let b = 2;', presets=['es2015'])
+        assert res['code'] == '"use strict";\n\nvar b = 2;'
+        # only the parent process uses the cache
+        assert cache.stats() == {'hits': 1, 'misses': 1, 'entries': 1}
+    finally:
+        pool.close()
+    assert pool._executor is None
+
+
+def test_babel_bundle_selection(tmp_path, monkeypatch):
+    from metapensiero.pj import api
+
+    reduced = tmp_path / 'babel-pj.min.js'
+    monkeypatch.setattr(api, 'BABEL_REDUCED', str(reduced))
+    monkeypatch.delenv('PJ_BABEL_JS', raising=False)
+    assert api.default_babel_compiler() == api.BABEL_FULL
+    reduced.write_text('var Babel = {};')
+    assert api.default_babel_compiler() == str(reduced)
+    monkeypatch.setenv('PJ_BABEL_JS', '/other/babel.js')
+    assert api.default_babel_compiler() == '/other/babel.js'
+
+
+def test_babel_bundle_without_babel(tmp_path):
+    from metapensiero.pj.api import new_babel_interpreter
+
+    bundle = tmp_path / 'babel.js'
+    bundle.write_text('(function (global) { global.Babel = {}; })({});')
+    with pytest.raises(ValueError, match='Babel.transform'):
+        new_babel_interpreter(str(bundle))
+
+
+@pytest.mark.skipif(not os.path.exists(api.BABEL_REDUCED),
+                    reason="the reduced BabelJS bundle isn't built, run "
+                    "'make babel-bundle'")
+def test_reduced_babel_bundle():
+    pool = api.BabelPool(1, babel_js=api.BABEL_REDUCED)
+    try:
+        res = pool.compile('let a = () => 1; async function f() {}',
+                           presets=['es2015', 'stage-3'],
+                           plugins=['transform-runtime'])
+        assert 'var a = function a()' in res['code']
+        assert 'babel-runtime' in res['code']
+    finally:
+        pool.close()
+
+
+def test_cli_babel_load_time(monkeypatch):
+    import io
+    from metapensiero.pj import api
+    from metapensiero.pj.__main__ import main
+
+    monkeypatch.setattr(api, 'BABEL_POOL', api.BabelPool(1))
+    fout, ferr = io.StringIO(), io.StringIO()
+    with pytest.raises(SystemExit) as exc:
+        main(['--babel-load-time'], fout, ferr)
+    assert exc.value.code == 0
+    assert ferr.getvalue().startswith(
+        'BabelJS loaded from %s in ' % api.BABEL_COMPILER)
+    assert ferr.getvalue().endswith(' seconds\n')
+    # the interpreter is kept for the following transpilations
+    assert len(api.BABEL_POOL.load_times) == 1
+    api.BABEL_POOL.compile('let a = 1;', presets=['es2015'])
+    assert len(api.BABEL_POOL.load_times) == 1
+
+
 class TestEvalFromFS:
 
     EXT = '.js'
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# :Project:  metapensiero.pj -- source maps tests
+# :Created:  dom 18 ott 2026 09:42:06 UTC
+# :License:  GNU General Public License version 3 or later
+#
+
+import io
+import json
+
+import pytest
+
+from metapensiero.pj.api import translates
+from metapensiero.pj.processor.sourcemaps import (
+    SourceMap, SourceMapDecodeError, Token, decode_mappings, decode_vlqs,
+    encode_index_map, encode_mappings, encode_vlq, encode_vlqs, identity_map,
+    load_source_map)
+
+
+SOURCE = """\
+def foo(a, b):
+    c = [x * 2 for x in a]
+    return {'c': c, 'b': b.value}
+
+foo([1, 2], bar)
+"""
+
+
+def test_columnar_storage():
+    smap = SourceMap()
+    smap.add_mapping(1, 5, 'a.py', 1, 1)
+    smap.add_mapping(0, 3, 'b.py', 2, 2, 'n')
+    smap.add_mapping(1, 2, 'a.py', 0, 0)
+    assert smap.sources == ['a.py', 'b.py']
+    assert smap.names == ['n']
+    assert smap.tokens == [Token(0, 3, 'b.py', 2, 2, 'n'),
+                           Token(1, 2, 'a.py', 0, 0),
+                           Token(1, 5, 'a.py', 1, 1)]
+    assert list(smap.dst_lines) == [0, 1, 1]
+    with pytest.raises(ValueError):
+        smap.add_mapping(1, 5, 'a.py', 3, 3)
+
+
+def test_decode_roundtrip():
+    js_text, smap = translates(SOURCE, src_filename='foo.py')
+    decoded = SourceMap.decode(smap.stringify())
+    assert len(decoded) == len(smap)
+    assert decoded.tokens == smap.tokens
+    assert decoded.encode() == smap.encode()
+
+
+def test_vlq_roundtrip():
+    values = [0, 1, -1, 15, -16, 16, 1000, -1000, 2047, 2048, -123456789]
+    assert decode_vlqs(''.join(encode_vlq(v) for v in values)) == values
+    assert encode_vlqs(values) == ''.join(encode_vlq(v) for v in values)
+    with pytest.raises(SourceMapDecodeError):
+        decode_vlqs('A!')
+
+
+def test_mappings_roundtrip():
+    mappings = 'AAAA,EAAEA;;IACA,GAAG;C'
+    columns = decode_mappings(mappings)
+    assert [list(c) for c in columns] == [
+        [0, 0, 2, 2, 3],
+        [0, 2, 4, 7, 1],
+        [0, 0, 0, 0, -1],
+        [0, 0, 1, 1, 1],
+        [0, 2, 2, 5, 5],
+        [-1, 0, -1, -1, -1],
+    ]
+    assert encode_mappings(*columns) == mappings
+
+
+def test_compose():
+    inner = SourceMap()
+    inner.add_mapping(0, 0, 'a.py', 0, 0)
+    inner.add_mapping(0, 4, 'a.py', 0, 2, 'foo')
+    inner.add_mapping(1, 2, 'a.py', 1, 4)
+    outer = SourceMap(file='a.min.js')
+    outer.add_mapping(0, 0, 'a.js', 0, 0)
+    outer.add_mapping(0, 6, 'a.js', 0, 5, 'bar')
+    outer.add_mapping(0, 9, 'a.js', 0, 4)
+    outer.add_mapping(1, 0, 'a.js', 1, 0)
+    outer.add_mapping(2, 0, 'a.js', 1, 3)
+    outer.add_mapping(2, 1, 'other.js', 7, 7)
+    outer.add_mapping(2, 5)
+    composed = SourceMap.compose(outer, inner)
+    # the segments without a correspondence are kept unmapped
+    assert composed.tokens == [
+        Token(0, 0, 'a.py', 0, 0),
+        Token(0, 6, 'a.py', 0, 2, 'bar'),
+        Token(0, 9, 'a.py', 0, 2, 'foo'),
+        Token(1, 0, None),
+        Token(2, 0, 'a.py', 1, 4),
+        Token(2, 1, None),
+        Token(2, 5, None),
+    ]
+    assert composed.file == 'a.min.js'
+    encoded = composed.encode()
+    assert encoded['file'] == 'a.min.js'
+    assert SourceMap.decode(encoded).encode() == encoded
+    out = io.StringIO()
+    composed.dump(out)
+    assert json.loads(out.getvalue()) == encoded
+    assert SourceMap.compose(outer, inner, 'a.js').tokens[-2] == Token(
+        2, 1, 'other.js', 7, 7)
+
+
+def test_lookup():
+    js_text, smap = translates(SOURCE, src_filename='foo.py')
+    tokens = smap.tokens
+    for t in tokens:
+        assert smap.lookup(t.dst_line, t.dst_col) == t
+    first = tokens[0]
+    assert smap.lookup(first.dst_line, first.dst_col - 1) is None
+    assert smap.lookup(1000, 0) is None
+    line_tokens = smap.lookup_source('foo.py', 4)
+    assert line_tokens == [t for t in tokens if t.src_line == 4]
+    for t in line_tokens:
+        assert t in smap.lookup_source('foo.py', 4, t.src_col)
+    assert smap.lookup_source('bar.py', 4) == []
+
+
+def test_load_source_map(tmp_path):
+    js_text, smap = translates(SOURCE, src_filename='foo.py')
+    map_path = tmp_path / 'foo.js.map'
+    map_path.write_text(smap.stringify())
+    loaded = load_source_map(str(map_path))
+    assert loaded.tokens == smap.tokens
+    assert load_source_map(str(map_path)) is loaded
+    map_path.write_text(identity_map('a = 1\n', 'a.py').stringify())
+    assert load_source_map(str(map_path)) is not loaded
+
+
+def test_index_map():
+    js_a, smap_a = translates(SOURCE, src_filename='a.py')
+    js_b, smap_b = translates('x = foo(1)\n', src_filename='b.py')
+    bundle = 'var prefix = 1; ' + js_a + '\n' + js_b
+    offset_b = bundle.count('\n', 0, len(bundle) - len(js_b))
+    index = encode_index_map([(0, 16, smap_a), (offset_b, 0, smap_b.encode())],
+                             file='bundle.js')
+    assert [s['offset'] for s in index['sections']] == [
+        {'line': 0, 'column': 16}, {'line': offset_b, 'column': 0}]
+    decoded = SourceMap.decode(json.dumps(index))
+    assert decoded.sources == ['a.py', 'b.py']
+    assert len(decoded) == len(smap_a) + len(smap_b)
+    for t in smap_a.tokens:
+        col = t.dst_col + 16 if t.dst_line == 0 else t.dst_col
+        assert decoded.lookup(t.dst_line, col) == t._replace(dst_col=col)
+    for t in smap_b.tokens:
+        line = t.dst_line + offset_b
+        assert decoded.lookup(line, t.dst_col) == t._replace(dst_line=line)
+    with pytest.raises(ValueError):
+        encode_index_map([(1, 0, smap_a), (0, 0, smap_b)])
@@ -6,6 +6,8 @@
 # :License:  GNU General Public License version 3 or later
 #
 
+import ast
+
 import pytest
 
 from metapensiero.pj.api import translates
@@ -26,6 +28,53 @@ def test_body_names_stop_at_func(astobj):
     assert body_local_names(astobj(outer).body) == {'yes', 'yes2'}
 
 
+def test_scope_analysis(astobj):
+
+    from metapensiero.pj.processor.scopes import ScopeAnalysis
+
+    def outer(no):
+        yes = 1
+
+        class Foo:
+
+            def gen(self):
+                a, b = yield self
+                return a
+
+            def meth(self):
+                global yes
+                yes = c = 2
+
+                def inner():
+                    raise ValueError()
+
+        yes2 = 3
+
+    top = astobj(outer)
+    analysis = ScopeAnalysis(top)
+    foo = top.body[1]
+    gen, meth = foo.body
+    inner = meth.body[2]
+    scopes = analysis.scopes
+    assert scopes[top].local_names == {'yes', 'yes2'}
+    assert scopes[gen].local_names == {'a', 'b'}
+    assert scopes[gen].is_generator and scopes[gen].has_return
+    assert scopes[gen].enclosing_class is foo
+    assert scopes[gen].enclosing_function is top
+    assert scopes[meth].local_names == {'c'}
+    assert scopes[meth].globals == {'yes'}
+    assert not scopes[meth].is_generator and not scopes[meth].has_raise
+    assert scopes[inner].has_raise
+    assert scopes[inner].enclosing_function is meth
+    assert scopes[inner].enclosing_class is foo
+    assert analysis.parents[inner] is meth
+    assert analysis.contains(gen.body, ast.Return)
+    assert not analysis.contains(foo.body, ast.Return)
+    assert not analysis.contains(meth.body, ast.Raise)
+    assert analysis.contains([gen], ast.Return) is False
+    assert analysis.contains(foo.body, ast.Name) is None
+
+
 def test_textwrap_behavior():
     txt = " " * 4 + "foo bar" + "\n" + " " * 4 + "bar foo" + "\n"
     assert len(txt) == 24
@@ -49,3 +98,431 @@ class TestTranslationFromFS:
         from metapensiero.pj.processor.exceptions import UnsupportedSyntaxError
         with pytest.raises(UnsupportedSyntaxError):
             translates(py_src, **options)[0]
+
+
+def test_transformations_table_is_shared():
+    import ast
+    from metapensiero.pj import transformations
+    from metapensiero.pj.js_ast import JSStatements
+    from metapensiero.pj.processor.transforming import (
+        Transformer, add_transformation, get_transformations,
+        invalidate_transformations)
+
+    t1 = Transformer(transformations, JSStatements)
+    t2 = Transformer(transformations, JSStatements)
+    assert t1.transformations is t2.transformations
+    assert Transformer.new_from(t1).transformations is t1.transformations
+    assert ast.Call in t1.transformations
+
+    def Pass_custom(t, x):
+        from metapensiero.pj.js_ast import JSCommentBlock
+        return JSCommentBlock('custom pass')
+
+    try:
+        add_transformation(transformations, ast.Pass, Pass_custom)
+        assert 'custom pass' in translates('pass')[0]
+    finally:
+        invalidate_transformations(transformations)
+    assert get_transformations(transformations) is not t1.transformations
+    assert 'custom pass' not in translates('pass')[0]
+
+
+def test_rules_index():
+    import ast
+    from metapensiero.pj import transformations
+    from metapensiero.pj.js_ast import JSStatements, JSStr
+    from metapensiero.pj.processor.transforming import (
+        Transformer, add_transformation, invalidate_transformations, matches)
+    from metapensiero.pj.transformations import special
+
+    t = Transformer(transformations, JSStatements)
+    call = ast.parse('print(a)').body[0].value
+    assert t.rules_for(call) == [special.Call_print, special.Call_new,
+                                 special.Call_super, special.Call_default]
+    call = ast.parse('foo.bar(a)').body[0].value
+    assert t.rules_for(call) == [special.Call_new, special.Call_super,
+                                 special.Call_default]
+    compare = ast.parse('a in b').body[0].value
+    assert t.rules_for(compare) == special.Compare
+    compare = ast.parse('a < b').body[0].value
+    assert t.rules_for(compare) == [special.Compare_default]
+
+    @matches('foo')
+    def Call_foo(t, x):
+        return JSStr('foo called')
+
+    try:
+        add_transformation(transformations, ast.Call, Call_foo)
+        assert t.rules_for(call)[0] is special.Call_new
+        assert 'foo called' in translates('foo(1)')[0]
+        assert 'bar(1)' in translates('bar(1)')[0]
+    finally:
+        invalidate_transformations(transformations)
+
+
+def test_snippets_are_translated_once():
+    from metapensiero.pj.processor import transforming
+
+    src = "assert 'a' in b"
+    transforming._snippets_cache.clear()
+    first = translates(src)[0]
+    assert len(transforming._snippets_cache) == 1
+    cached, = transforming._snippets_cache.values()
+    args = list(cached.transformed_args)
+    assert translates(src)[0] == first
+    assert translates(src, enable_es6=True)[0] != first
+    assert len(transforming._snippets_cache) == 2
+    assert cached.transformed_args == args
+
+
+def test_cli_compiles_directory_in_parallel(tmp_path):
+    import io
+    from metapensiero.pj.__main__ import main
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.py').write_text('a = 1\n')
+    (src / 'b.py').write_text('b = 1 +\n')
+    (src / 'c.py').write_text('c = 3\n')
+    dst = tmp_path / 'js'
+    fout, ferr = io.StringIO(), io.StringIO()
+    with pytest.raises(SystemExit) as exc:
+        main(['-j', '2', '-o', str(dst), str(src)], fout, ferr)
+    assert exc.value.code == 1
+    assert fout.getvalue().splitlines() == [
+        'Compiled file %s' % (src / 'a.py'),
+        'Compiled file %s' % (src / 'c.py')]
+    assert str(src / 'b.py') in ferr.getvalue()
+    assert (dst / 'a.js').exists() and (dst / 'c.js').exists()
+
+
+def test_cli_incremental_build(tmp_path):
+    import io
+    from metapensiero.pj.__main__ import main
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.py').write_text('a = 1\n')
+    (src / 'b.py').write_text('b = 2\n')
+    dst = tmp_path / 'js'
+
+    def build():
+        fout = io.StringIO()
+        with pytest.raises(SystemExit) as exc:
+            main(['-j', '1', '--incremental', '-o', str(dst), str(src)],
+                 fout, io.StringIO())
+        assert exc.value.code == 0
+        return fout.getvalue().splitlines()
+
+    assert len(build()) == 2
+    assert build() == []
+    (src / 'a.py').write_text('a = 3\n')
+    (src / 'b.py').unlink()
+    assert build() == ['Removed file %s' % (dst / 'b.js'),
+                       'Removed file %s' % (dst / 'b.js.map'),
+                       'Compiled file %s' % (src / 'a.py')]
+    assert 'a = 3' in (dst / 'a.js').read_text()
+
+
+def test_cli_incremental_build_checks_sources(tmp_path, monkeypatch):
+    import io
+    from metapensiero.pj import api
+    from metapensiero.pj.__main__ import main
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.py').write_text('a = 1\n')
+    dst = tmp_path / 'js'
+
+    def build():
+        fout = io.StringIO()
+        with pytest.raises(SystemExit):
+            main(['-j', '1', '--incremental', '-o', str(dst), str(src)],
+                 fout, io.StringIO())
+        return fout.getvalue().splitlines()
+
+    assert api.pj_version() != 'unknown'
+    assert build() == ['Compiled file %s' % (src / 'a.py')]
+    assert build() == []
+    # a change to the sources of pj, with the same version, invalidates
+    # the manifest
+    monkeypatch.setattr(api, 'PJ_FINGERPRINT', 'changed')
+    assert build() == ['Compiled file %s' % (src / 'a.py')]
+
+
+def test_cli_watch_recompiles_only_changes(tmp_path):
+    import io
+    from metapensiero.pj.__main__ import compile_sources, parser, Reporter
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.py').write_text('a = 1\n')
+    single = tmp_path / 'single.py'
+    single.write_text('s = 1\n')
+    args = parser.parse_args(['--watch', str(src), str(single)])
+    sources = [(src, None), (single, None)]
+    manifests, stats = {}, {}
+
+    def build():
+        fout = io.StringIO()
+        compile_sources(sources, args, Reporter(fout, io.StringIO()),
+                        manifests, stats)
+        return fout.getvalue().splitlines()
+
+    assert len(build()) == 2
+    assert build() == []
+    single.write_text('s = 2\n')
+    assert build() == ['Compiled file %s' % single]
+
+
+def test_cli_watch_survives_removed_files(tmp_path, monkeypatch):
+    import io
+    from metapensiero.pj import __main__ as cli
+
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'a.py').write_text('a = 1\n')
+    (src / 'b.py').write_text('b = 1\n')
+    single = tmp_path / 'single.py'
+    single.write_text('s = 1\n')
+    args = cli.parser.parse_args(['--watch', str(src), str(single)])
+    sources = [(src, None), (single, None)]
+    manifests, stats = {}, {}
+    fout, ferr = io.StringIO(), io.StringIO()
+    rep = cli.Reporter(fout, ferr)
+    assert cli.compile_sources(sources, args, rep, manifests, stats) == 0
+    # the files are removed after the directory is walked
+    walked = list(cli.walk_sources(src))
+    monkeypatch.setattr(cli, 'walk_sources', lambda *a: iter(walked))
+    (src / 'b.py').unlink()
+    single.unlink()
+    fout.truncate(0)
+    fout.seek(0)
+    assert cli.compile_sources(sources, args, rep, manifests, stats) == 0
+    assert fout.getvalue().splitlines() == ['Removed file %s' % (src / 'b.js'),
+                                            'Removed file %s' %
+                                            (src / 'b.js.map')]
+    assert str(single) not in stats
+    assert 'b.py' not in manifests[src].entries
+    # an error in an iteration doesn't stop the watch loop
+    monkeypatch.undo()
+    calls = []
+
+    def compile_sources(*a, **kw):
+        calls.append(a)
+        if len(calls) == 2:
+            raise OSError('gone')
+        return 0
+
+    def sleep(interval):
+        if len(calls) == 3:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(cli, 'compile_sources', compile_sources)
+    monkeypatch.setattr(cli.time, 'sleep', sleep)
+    with pytest.raises(SystemExit) as exc:
+        cli.main(['--watch', str(src)], io.StringIO(), ferr)
+    assert exc.value.code == 0
+    assert len(calls) == 3
+    assert 'OSError: gone' in ferr.getvalue()
+
+
+def test_cli_watch_loads_babel_in_process(tmp_path, monkeypatch):
+    import io
+    from metapensiero.pj import __main__ as cli
+
+    events = []
+
+    class Pool:
+        def warm(self, count=None):
+            events.append(('warm', count))
+
+    def compile_sources(sources, args, rep, manifests, stats, jobs=1):
+        events.append(('compile', jobs))
+        return 0
+
+    def sleep(interval):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(cli.api, 'get_babel_pool', Pool)
+    monkeypatch.setattr(cli, 'compile_sources', compile_sources)
+    monkeypatch.setattr(cli.time, 'sleep', sleep)
+    with pytest.raises(SystemExit):
+        cli.main(['-5', '--watch', '-j', '2', str(tmp_path)],
+                 io.StringIO(), io.StringIO())
+    assert events == [('warm', 1), ('compile', 2)]
+
+
+def test_translate_without_sourcemap(tmp_path):
+    from metapensiero.pj.api import translate_file
+
+    src = 'def foo(a):\n    return a in [1, 2]\n'
+    js_text, src_map = translates(src)
+    assert src_map.tokens
+    assert translates(src, sourcemap=False) == (js_text, None)
+    py_file = tmp_path / 'foo.py'
+    py_file.write_text(src)
+    translate_file(str(py_file), sourcemap=False)
+    assert (tmp_path / 'foo.js').read_text() == js_text
+    assert not (tmp_path / 'foo.js.map').exists()
+
+
+def test_external_runtime_module(tmp_path):
+    import io
+    from metapensiero.pj.api import translate_runtime
+    from metapensiero.pj.__main__ import main
+
+    src = 'def foo(a):\n    return a in [1, 2]\n'
+    js_text = translates(src, enable_es6=True,
+                         runtime_module='./pj_runtime.js')[0]
+    assert js_text.startswith("import * as _pj from './pj_runtime.js';\n")
+    assert '_pj_snippets' not in js_text
+    assert '_pj.in_es6(a, [1, 2])' in js_text
+    assert translates('x = 1', enable_es6=True,
+                      runtime_module='pj_runtime')[0] == 'var x;\nx = 1;\n'
+    with pytest.raises(ValueError):
+        translates(src, runtime_module='pj_runtime')
+
+    runtime = translate_runtime()
+    assert 'export {_assert, _in, in_es6,' in runtime
+    runtime_file = tmp_path / 'pj_runtime.js'
+    with pytest.raises(SystemExit) as exit:
+        main(['--write-runtime', str(runtime_file)], io.StringIO(),
+             io.StringIO())
+    assert exit.value.code == 0
+    assert runtime_file.read_text() == runtime
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_translate_many(jobs):
+    from metapensiero.pj.api import translate_many
+    from metapensiero.pj.processor.exceptions import TransformationError
+
+    sources = ['x = %d' % i for i in range(40)]
+    sources[7] = ('def foo(a):\n    return a in b\n', 'foo.py')
+    expected = [translates(s) if isinstance(s, str)
+                else translates(s[0], src_filename=s[1]) for s in sources]
+    results = translate_many(iter(sources), jobs=jobs, chunksize=3)
+    for (js_text, src_map), (exp_text, exp_map) in zip(results, expected):
+        assert js_text == exp_text
+        assert src_map.tokens == exp_map.tokens
+    assert next(results, None) is None
+
+    sources[3] = 'class A:\n    pass\n'
+    results = list(translate_many(sources, jobs=jobs, chunksize=3,
+                                  return_exceptions=True))
+    assert isinstance(results[3], TransformationError)
+    assert results[4][0] == expected[4][0]
+    with pytest.raises(TransformationError):
+        list(translate_many(sources, jobs=jobs, chunksize=3))
+
+
+def test_translate_file_streams_output(tmp_path):
+    import io
+    from metapensiero.pj.api import translate_file, _translate_block
+
+    src = ''.join('def foo%d(a):\n    return a in [%d, 2]\n' % (i, i)
+                  for i in range(100))
+    js_text, src_map = translates(src, src_filename='foo.py')
+    py_file = tmp_path / 'foo.py'
+    py_file.write_text(src)
+    translate_file(str(py_file), str(tmp_path / 'foo.js'))
+    assert (tmp_path / 'foo.js').read_text() == (
+        js_text + '\n//# sourceMappingURL=foo.js.map\n')
+    assert (tmp_path / 'foo.js.map').read_text() == src_map.stringify()
+
+    block = _translate_block(src, True, None, False, False, False, None)[0]
+    out = io.StringIO()
+    assert block.write(out, src, 'foo.py').tokens == src_map.tokens
+    assert out.getvalue() == js_text
+    # the lines weren't kept
+    assert block._lines is None
+
+
+@pytest.mark.parametrize('kind', ['binop', 'dict', 'elif'])
+def test_deeply_nested_input(kind):
+    import sys
+
+    depth = sys.getrecursionlimit()
+    if kind == 'binop':
+        depth *= 2
+        src = 'x = %s\n' % ' + '.join('a%d' % i for i in range(depth))
+        expected = 'a%d' % (depth - 1)
+    elif kind == 'dict':
+        # the Python parser doesn't allow more than 200 nesting levels
+        depth = 190
+        src = "x = %s1%s\n" % ("{'a': " * depth, '}' * depth)
+        expected = '{"a": 1}' + '}' * (depth - 1)
+    else:
+        src = 'if a == 0:\n    x = 0\n' + ''.join(
+            'elif a == %d:\n    x = %d\n' % (i, i) for i in range(1, depth))
+        expected = 'x = %d;' % (depth - 1)
+    js_text, src_map = translates(src, src_filename='deep.py')
+    assert expected in js_text
+    assert len(src_map) > depth
+
+
+def test_serialization_leaves_nodes_untouched():
+    from concurrent.futures import ThreadPoolExecutor
+    from metapensiero.pj.js_ast import JSFunction, TargetNode
+    from metapensiero.pj.processor import transforming
+
+    src = "assert 'a' in b\nx = [i for i in b if i in c]\n"
+    transforming._snippets_cache.clear()
+    expected = translates(src)[0]
+    cached, = transforming._snippets_cache.values()
+    nodes, stack = [], [cached]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, TargetNode):
+            nodes.append(item)
+            stack.extend(item.transformed_args or ())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    state = [dict(vars(n)) for n in nodes]
+    text = str(cached)
+    # a serialization stopped partway leaves nothing behind
+    func = next(n for n in nodes if isinstance(n, JSFunction))
+    partial = func.serialize()
+    next(partial)
+    del partial
+    assert [dict(vars(n)) for n in nodes] == state
+    assert str(cached) == text
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda i: translates(src)[0], range(16)))
+    assert results == [expected] * 16
+
+
+def test_generated_names():
+    import re
+
+    def names(js_text):
+        return set(re.findall(r'_pj_\w+', js_text))
+
+    # the names of every comprehension are local to its function
+    src = 'x = [%s]\n' % ', '.join('[i for i in a%d]' % n for n in range(20))
+    assert names(translates(src)[0]) == {'_pj_a', '_pj_b', '_pj_c', '_pj_d'}
+    # the names used by the code are skipped
+    src = '_pj_a = 1\nfor x in a:\n    print(x, _pj_a)\n'
+    assert names(translates(src)[0]) == {'_pj_a', '_pj_b', '_pj_c', '_pj_d'}
+    # there's no limit to the names that can be generated
+    src = 'def f(a):\n%s%spass\n' % (
+        ''.join('    ' * (i + 1) + 'for x%d in a:\n' % i for i in range(20)),
+        '    ' * 21)
+    assert len(names(translates(src)[0])) == 60
+
+
+def test_scoped_context():
+    from metapensiero.pj.processor.util import ScopedContext
+
+    ctx = ScopedContext(a=1)
+    ctx.push(b=2)
+    ctx['a'] = 3
+    ctx.push(a=4)
+    del ctx['b']
+    assert dict(ctx) == {'a': 4}
+    ctx.pop()
+    assert dict(ctx) == {'a': 3, 'b': 2}
+    ctx.pop()
+    assert dict(ctx) == {'a': 1}
+    assert ctx.get('b') is None
@@ -0,0 +1,62 @@
+// -*- coding: utf-8 -*-
+// :Project:  metapensiero.pj -- reduced BabelJS bundle
+// :Created:  dom 18 ott 2026 10:36:58 UTC
+// :License:  GNU General Public License version 3 or later
+//
+
+// Export a ``Babel.transform()`` compatible with the one of
+// babel-standalone, but knowing only the presets and the plugins used by
+// JavaScripthon, so that the bundle is much faster to load. The bundle is
+// built with ``--standalone Babel``: Duktape has no ``global`` nor
+// ``window``, so the UMD wrapper assigns it to the top level ``this``.
+
+var babel = require('babel-core');
+
+var PRESETS = {
+    'es2015': require('babel-preset-es2015'),
+    'stage-3': require('babel-preset-stage-3')
+};
+
+var PLUGINS = {
+    'transform-runtime': require('babel-plugin-transform-runtime')
+};
+
+
+function resolve(items, available, kind) {
+    return (items || []).map(function (item) {
+        var name = Array.isArray(item) ? item[0] : item;
+        if (typeof name !== 'string') {
+            return item;
+        }
+        if (!available.hasOwnProperty(name)) {
+            throw new Error('The ' + kind + ' "' + name + '" is not ' +
+                            'available in the pj BabelJS bundle');
+        }
+        return Array.isArray(item) ?
+            [available[name]].concat(item.slice(1)) : available[name];
+    });
+}
+
+
+function transform(code, options) {
+    var opts = {}, key;
+    options = options || {};
+    for (key in options) {
+        if (options.hasOwnProperty(key)) {
+            opts[key] = options[key];
+        }
+    }
+    // there's no filesystem to look for .babelrc files into
+    opts.babelrc = false;
+    opts.presets = resolve(options.presets, PRESETS, 'preset');
+    opts.plugins = resolve(options.plugins, PLUGINS, 'plugin');
+    return babel.transform(code, opts);
+}
+
+
+module.exports = {
+    transform: transform,
+    version: babel.version,
+    availablePresets: PRESETS,
+    availablePlugins: PLUGINS
+};